@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure the cost of cleaning a listing page.
+
+No database is needed::
+
+  $ python benchmarks/fix_utf8_encoding.py [repeat]
+"""
+
+import os
+import sys
+import timeit
+
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+settings.configure(AMAVIS_DEFAULT_DATABASE_ENCODING="LATIN1")
+
+from modoboa_amavis import utils  # NOQA:E402
+
+# A page of 40 rows from a typical spam campaign: a few distinct values
+# (plain ASCII, badly escaped utf-8 and non utf-8) repeated many times.
+VALUES = [
+    "Your invoice is ready",
+    "Bonjour \xc3\xa0 tous, d\xc3\xa9couvrez nos offres",
+    "Gro\xdfe Rabatte f\xfcr Sie",
+    "\xf0\x9f\x92\xb0 Win money now \xf0\x9f\x92\xb0",
+] * 10
+
+
+def one_by_one():
+    """Clean values one at a time."""
+    return [utils.fix_utf8_encoding(value) for value in VALUES]
+
+
+def batch():
+    """Clean values using the batch API."""
+    return utils.fix_utf8_encodings(VALUES)
+
+
+def uncached():
+    """Clean values one at a time, without memoization."""
+    return [
+        utils._fix_utf8_encoding.__wrapped__(value) for value in VALUES]
+
+
+def main(repeat):
+    for func in (uncached, one_by_one, batch):
+        timer = timeit.Timer(func)
+        best = min(timer.repeat(repeat=repeat, number=100))
+        print("{:<12} {:.3f} ms/page".format(func.__name__, best * 10))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
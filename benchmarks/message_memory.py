@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measure the memory needed to display a big quarantined message.
+
+The former pipeline (join chunks, decode to str, parse the str) is
+compared with the bytes-native one used by SQLemail. No database is
+needed::
+
+  $ python benchmarks/message_memory.py [attachment size in MB]
+"""
+
+import base64
+import email
+import os
+import sys
+import tracemalloc
+
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+settings.configure(AMAVIS_DEFAULT_DATABASE_ENCODING="LATIN1")
+
+from modoboa_amavis import utils  # NOQA:E402
+
+# Maximum size of a quarantine.mail_text chunk written by amavis
+CHUNK_SIZE = 16384
+
+MESSAGE = b"""From: spammer@example.com
+To: user@example.com
+Subject: Big message
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain; charset=iso-8859-1
+Content-Transfer-Encoding: 8bit
+
+Caf\xe9 cr\xe8me
+--BOUNDARY
+Content-Type: application/octet-stream; name="big.bin"
+Content-Transfer-Encoding: base64
+Content-Disposition: attachment; filename="big.bin"
+
+%s
+--BOUNDARY--
+"""
+
+
+def build_chunks(size):
+    """Build a message with an attachment of :kw:`size` bytes."""
+    payload = base64.encodebytes(os.urandom(size))
+    content = MESSAGE % payload
+    return [
+        content[pos:pos + CHUNK_SIZE]
+        for pos in range(0, len(content), CHUNK_SIZE)
+    ]
+
+
+def get_text(msg):
+    """Return the first text part of :kw:`msg`, decoded."""
+    for part in msg.walk():
+        if part.get_content_maintype() == "text":
+            payload = part.get_payload(decode=True)
+            return payload.decode(part.get_content_charset(), "replace")
+    return None
+
+
+def former(chunks):
+    """Join and decode chunks, then parse the resulting str."""
+    content = b"".join(chunks).decode("utf-8", "replace")
+    return get_text(email.message_from_string(content))
+
+
+def bytes_native(chunks):
+    """Parse chunks as they come."""
+    return get_text(utils.message_from_chunks(chunks))
+
+
+def main(size):
+    chunks = build_chunks(size * 1024 * 1024)
+    for func in (former, bytes_native):
+        tracemalloc.start()
+        text = func(iter(chunks))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("{:<13} peak {:7.1f} MB  text={!r}".format(
+            func.__name__, peak / 1024 / 1024, text.strip()))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
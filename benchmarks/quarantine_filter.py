@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the strategies used to select quarantined messages.
+
+This script must be run against a real amavis database, from a
+modoboa instance directory::
+
+  $ cd <modoboa_instance_dir>
+  $ DJANGO_SETTINGS_MODULE=<instance>.settings \\
+      python <path_to>/benchmarks/quarantine_filter.py [repeat]
+"""
+
+import os
+import sys
+import timeit
+
+import django
+
+sys.path.insert(0, os.getcwd())
+django.setup()
+
+from modoboa.core.models import User  # NOQA:E402
+from modoboa_amavis.modo_extension import Amavis  # NOQA:E402
+from modoboa_amavis.sql_connector import SQLconnector  # NOQA:E402
+
+STRATEGIES = ("subquery", "exists", "quar_type")
+
+
+def run(user, strategy):
+    """Count and fetch the first listing page using :kw:`strategy`."""
+    connector = SQLconnector(
+        user=user, navparams={"order": "-date", "page": 1})
+    connector.quarantine_filter = strategy
+    qset = connector._get_quarantine_content()
+    qset.count()
+    list(qset.order_by("-mail__time_num")[:40])
+
+
+def main(repeat):
+    Amavis().load()
+    user = User.objects.filter(is_superuser=True).first()
+    print("{:<10} {:>10} {:>10}".format("strategy", "best (s)", "avg (s)"))
+    for strategy in STRATEGIES:
+        timings = timeit.repeat(
+            lambda: run(user, strategy), number=1, repeat=repeat)
+        print("{:<10} {:>10.3f} {:>10.3f}".format(
+            strategy, min(timings), sum(timings) / len(timings)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -144,6 +144,7 @@ def create_quarantined_msg(rcpt, sender, rs, body, **kwargs):
         rid__domain="com.test",  # FIXME
         mail__sid__email=smart_bytes(sender),
         mail__sid__domain="",  # FIXME
+        mail__quar_type="Q",
         **kwargs
     )
     QuarantineFactory(
@@ -129,6 +129,15 @@ class ParametersForm(param_forms.AdminParametersForm):
         )
     )
 
+    exact_count_limit = forms.IntegerField(
+        label=gettext_lazy("Exact count limit"),
+        initial=10000,
+        help_text=gettext_lazy(
+            "Above this number of messages, the quarantine listing displays "
+            "an estimated count. Use 0 to always count exactly."
+        )
+    )
+
     sep1 = form_utils.SeparatorField(label=gettext_lazy("Messages releasing"))
 
     released_msgs_cleanup = form_utils.YesNoField(
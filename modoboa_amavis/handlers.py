@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals
 
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import signals
 from django.dispatch import receiver
 from django.template import Context, Template
@@ -11,16 +12,17 @@ from django.urls import reverse
 from django.utils.translation import gettext as _
 
 from modoboa.admin import models as admin_models, signals as admin_signals
-from modoboa.core import signals as core_signals
+from modoboa.core import models as core_models, signals as core_signals
 from modoboa.lib import signals as lib_signals
 from modoboa.parameters import tools as param_tools
 from . import forms
 from .lib import (
-    create_user_and_policy, create_user_and_use_policy, delete_user,
-    delete_user_and_policy, update_user_and_policy
+    clear_admin_reversed_domains, clear_pending_requests_counter,
+    clear_user_maddr_ids, create_user_and_policy, create_user_and_use_policy,
+    delete_user, delete_user_and_policy, update_user_and_policy
 )
 from .models import Policy, Users
-from .sql_connector import SQLconnector
+from .sql_connector import SQLconnector, clear_listing_cache
 
 
 @receiver(core_signals.extra_user_menu_entries)
@@ -138,6 +140,59 @@ def on_mailboxalias_deleted(sender, instance, **kwargs):
     Users.objects.filter(email__in=aliases).delete()
 
 
+@receiver(signals.post_save, sender=admin_models.Mailbox)
+def clear_mailbox_maddr_ids(sender, instance, **kwargs):
+    """Clear cached maddr ids when a mailbox is modified."""
+    clear_user_maddr_ids(instance.user_id)
+
+
+@receiver(signals.post_save, sender=admin_models.AliasRecipient)
+@receiver(signals.post_delete, sender=admin_models.AliasRecipient)
+def clear_aliasrecipient_maddr_ids(sender, instance, **kwargs):
+    """Clear cached maddr ids when an alias recipient changes."""
+    if instance.r_mailbox_id is None:
+        return
+    user_pk = (
+        admin_models.Mailbox.objects.filter(pk=instance.r_mailbox_id)
+        .values_list("user", flat=True).first()
+    )
+    if user_pk is not None:
+        clear_user_maddr_ids(user_pk)
+
+
+@receiver(signals.post_save, sender=admin_models.Alias)
+def clear_alias_maddr_ids(sender, instance, **kwargs):
+    """Clear cached maddr ids when an alias is modified."""
+    if kwargs.get("created"):
+        return
+    users = admin_models.Mailbox.objects.filter(
+        aliasrecipient__alias=instance).values_list("user", flat=True)
+    for user_pk in users:
+        clear_user_maddr_ids(user_pk)
+
+
+@receiver(signals.post_save, sender=core_models.ObjectAccess)
+@receiver(signals.post_delete, sender=core_models.ObjectAccess)
+def clear_objectaccess_admin_domains(sender, instance, **kwargs):
+    """Clear cached domains when an admin gains or loses a domain."""
+    model = ContentType.objects.get_for_id(instance.content_type_id)
+    if model.model_class() is not admin_models.Domain:
+        return
+    clear_admin_reversed_domains(instance.user_id)
+    clear_pending_requests_counter(instance.user_id)
+    clear_listing_cache()
+
+
+@receiver(signals.post_save, sender=admin_models.Domain)
+def clear_domain_admin_domains(sender, instance, **kwargs):
+    """Clear cached domains of the admins of a modified domain."""
+    if kwargs.get("created"):
+        return
+    for user_pk in instance.owners.values_list("user", flat=True):
+        clear_admin_reversed_domains(user_pk)
+        clear_pending_requests_counter(user_pk)
+
+
 @receiver(core_signals.extra_static_content)
 def extra_static_content(sender, caller, st_type, user, **kwargs):
     """Send extra javascript."""
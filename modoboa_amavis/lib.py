@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import contextlib
+import hashlib
 import os
 import re
+import shlex
 import socket
 import struct
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parseaddr
 from functools import wraps
 
@@ -11,6 +19,8 @@ import idna
 
 from django.conf import settings
 from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.db.models import Max, Q
 from django.urls import reverse
 from django.utils.translation import gettext as _
 
@@ -22,8 +32,8 @@ from modoboa.lib.exceptions import InternalError
 from modoboa.lib.sysutils import exec_cmd
 from modoboa.lib.web_utils import NavigationParameters
 from modoboa.parameters import tools as param_tools
-from .models import Policy, Users
-from .utils import smart_bytes, smart_str
+from .models import Maddr, Policy, Users
+from .utils import EncodedValue, get_database_codec, smart_bytes, smart_str
 
 
 def selfservice(ssfunc=None):
@@ -52,20 +62,63 @@ def selfservice(ssfunc=None):
     return decorator
 
 
+_PDP_CONNECTIONS = threading.local()
+
+_RE_PDP_REPLY_END = re.compile(br"\r?\n\r?\n")
+
+
+def close_pdp_connections():
+    """Close the AM.PDP connections opened by the current thread."""
+    connections = getattr(_PDP_CONNECTIONS, "sockets", {})
+    while connections:
+        connections.popitem()[1].close()
+
+
 class AMrelease(object):
-    def __init__(self):
-        conf = dict(param_tools.get_global_parameters("modoboa_amavis"))
+    """AM.PDP client used to release messages.
+
+    amavisd accepts several requests per session so connections are
+    kept open and reused by the instances created later in the same
+    thread (one connection per worker).
+    """
+
+    def __init__(self, conf=None):
+        if conf is None:
+            conf = dict(param_tools.get_global_parameters("modoboa_amavis"))
+        if conf["am_pdp_mode"] == "inet":
+            self.family = socket.AF_INET
+            self.address = (conf["am_pdp_host"], conf["am_pdp_port"])
+        else:
+            self.family = socket.AF_UNIX
+            self.address = conf["am_pdp_socket"]
+        self.timeout = getattr(settings, "AMAVIS_PDP_TIMEOUT", 30)
+        if not hasattr(_PDP_CONNECTIONS, "sockets"):
+            _PDP_CONNECTIONS.sockets = {}
+        self.reused = True
+        self.sock = _PDP_CONNECTIONS.sockets.get(self.address)
+        if self.sock is None:
+            self.connect()
+        self._buffer = b""
+
+    def connect(self):
+        """Open a new connection and store it into the pool."""
         try:
-            if conf["am_pdp_mode"] == "inet":
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((conf["am_pdp_host"], conf["am_pdp_port"]))
-            else:
-                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                self.sock.connect(conf["am_pdp_socket"])
+            self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.address)
         except socket.error as err:
             raise InternalError(
                 _("Connection to amavis failed: %s" % str(err))
             )
+        self.reused = False
+        _PDP_CONNECTIONS.sockets[self.address] = self.sock
+
+    def close(self):
+        """Close the connection and remove it from the pool."""
+        if _PDP_CONNECTIONS.sockets.get(self.address) is self.sock:
+            del _PDP_CONNECTIONS.sockets[self.address]
+        self.sock.close()
+        self._buffer = b""
 
     def decode(self, answer):
         def repl(match):
@@ -73,23 +126,107 @@ class AMrelease(object):
 
         return re.sub(br"%([0-9a-fA-F]{2})", repl, answer)
 
-    def __del__(self):
-        self.sock.close()
+    def read_reply(self):
+        """Read a reply, which ends with an empty line.
 
-    def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send(
-            smart_bytes("""request=release
+        :return: the reply (bytes) or an empty string if the connection
+                 has been closed
+        """
+        while True:
+            match = _RE_PDP_REPLY_END.search(self._buffer)
+            if match:
+                reply = self._buffer[:match.start()]
+                self._buffer = self._buffer[match.end():]
+                return reply
+            data = self.sock.recv(4096)
+            if not data:
+                reply, self._buffer = self._buffer, b""
+                return reply
+            self._buffer += data
+
+    def send_requests(self, requests):
+        """Send several requests at once and read their replies.
+
+        When amavis closes the session (idle pooled connection or too
+        many requests), unanswered requests are sent again using a new
+        connection. Requests are never sent twice after an error.
+
+        :param list requests: list of requests (bytes)
+        :return: list of replies (an empty reply means failure)
+        """
+        replies = []
+        while True:
+            used = self.reused
+            sent = len(replies)
+            closed = False
+            try:
+                self.sock.sendall(b"".join(requests[sent:]))
+                for request in requests[sent:]:
+                    reply = self.read_reply()
+                    if not reply:
+                        closed = True
+                        break
+                    replies.append(reply)
+                    self.reused = True
+            except socket.error:
+                pass
+            if len(replies) == len(requests):
+                return replies
+            self.close()
+            if not closed or not (used or len(replies) > sent):
+                return replies + [b""] * (len(requests) - len(replies))
+            self.connect()
+
+    def build_request(self, mailid, secretid, recipient, *others):
+        """Build a release request for one or more recipients."""
+        recipients = "".join(
+            "recipient=%s\n" % smart_str(rcpt) for rcpt in (recipient,) + others
+        )
+        return smart_bytes("""request=release
 mail_id=%s
 secret_id=%s
 quar_type=Q
-recipient=%s
+%s
+""" % (smart_str(mailid), smart_str(secretid), recipients))
 
-""" % (smart_str(mailid), smart_str(secretid), smart_str(recipient))))
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search(br"250 [\d\.]+ Ok", answer):
-            return True
-        return False
+    def check_reply(self, reply):
+        """Tell if a reply indicates a success."""
+        return re.search(br"250 [\d\.]+ Ok", self.decode(reply)) is not None
+
+    def sendreq(self, mailid, secretid, recipient, *others):
+        reply = self.send_requests(
+            [self.build_request(mailid, secretid, recipient, *others)])[0]
+        return self.check_reply(reply)
+
+    def release_many(self, messages, batch_size=50):
+        """Release several messages using pipelined requests.
+
+        Recipients of the same message are grouped into a single
+        request. Requests are sent by batches of batch_size, over the
+        same connection.
+
+        :param list messages: list of (mail_id, secret_id, recipient)
+        :return: list of booleans (one per recipient), in the same order
+        """
+        groups = {}
+        for index, (mailid, secretid, recipient) in enumerate(messages):
+            key = (smart_str(mailid), smart_str(secretid))
+            groups.setdefault(key, []).append(index)
+        keys = list(groups)
+        requests = [
+            self.build_request(
+                mailid, secretid,
+                *[messages[index][2] for index in groups[(mailid, secretid)]])
+            for mailid, secretid in keys
+        ]
+        results = [False] * len(messages)
+        for pos in range(0, len(requests), batch_size):
+            replies = self.send_requests(requests[pos:pos + batch_size])
+            for key, reply in zip(keys[pos:pos + batch_size], replies):
+                result = self.check_reply(reply)
+                for index in groups[key]:
+                    results[index] = result
+        return results
 
 
 class SpamassassinClient(object):
@@ -164,8 +301,39 @@ class SpamassassinClient(object):
             raise InternalError(_("Local domain not found"))
         return domain
 
-    def _learn(self, rcpt, msg, mtype):
-        """Internal method to call the learning command."""
+    def _exec_learn_cmd(self, cmd, chunks):
+        """Execute a learning command, streaming the message to it.
+
+        Output goes to a temporary file so the command can't block
+        while we are still writing.
+
+        :param str cmd: the command to execute
+        :param chunks: an iterable of bytes-like objects
+        :return: return code, command output
+        """
+        with tempfile.TemporaryFile() as output:
+            process = subprocess.Popen(
+                cmd, shell=True, stdin=subprocess.PIPE, stdout=output,
+                stderr=subprocess.STDOUT, **self._learn_cmd_kwargs)
+            try:
+                # The command may exit without reading everything
+                with contextlib.suppress(BrokenPipeError):
+                    for chunk in chunks:
+                        process.stdin.write(chunk)
+            except BaseException:
+                # Reading the message failed, don't leave the command
+                # waiting for the rest of it.
+                process.kill()
+                raise
+            finally:
+                with contextlib.suppress(BrokenPipeError):
+                    process.stdin.close()
+                process.wait()
+            output.seek(0)
+            return process.returncode, output.read()
+
+    def _get_username(self, rcpt):
+        """Return the username messages of rcpt are learnt for."""
         if self._username is None:
             if self._recipient_db == "global":
                 username = self._default_username
@@ -202,28 +370,106 @@ class SpamassassinClient(object):
                     self._setup_cache[username] = True
         if username not in self._username_cache:
             self._username_cache.append(username)
-        cmd = self._learn_cmd.format(mtype, username)
-        code, output = exec_cmd(
-            cmd, pinput=smart_bytes(msg), **self._learn_cmd_kwargs)
+        return username
+
+    def _learn(self, rcpt, msg, mtype):
+        """Internal method to call the learning command."""
+        cmd = self._learn_cmd.format(mtype, self._get_username(rcpt))
+        if isinstance(msg, (bytes, str)):
+            msg = [smart_bytes(msg)]
+        code, output = self._exec_learn_cmd(cmd, msg)
+        if code in self._expected_exit_codes:
+            return True
+        self.error = smart_str(output)
+        return False
+
+    def _learn_group(self, username, messages, mtype):
+        """Learn several messages using a single sa-learn call.
+
+        Messages are spooled into a temporary directory, one file per
+        message, which is given to sa-learn.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            for index, msg in enumerate(messages):
+                if isinstance(msg, (bytes, str)):
+                    msg = [smart_bytes(msg)]
+                path = os.path.join(directory, str(index))
+                with open(path, "wb") as fp:
+                    for chunk in msg:
+                        fp.write(chunk)
+            cmd = "{} {}".format(
+                self._learn_cmd.format(mtype, username),
+                shlex.quote(directory))
+            code, output = self._exec_learn_cmd(cmd, [])
         if code in self._expected_exit_codes:
             return True
         self.error = smart_str(output)
         return False
 
+    def learn_many(self, messages, mtype):
+        """Learn several messages.
+
+        When sa-learn is local, messages are grouped by username and
+        each group (by batches of AMAVIS_SA_LEARN_BATCH_SIZE messages)
+        is learnt using a single command. spamc can only learn one
+        message at a time. Processing stops at the first failure.
+
+        :param list messages: list of (rcpt, msg) tuples, msg being
+                              str, bytes or an iterable of bytes
+        :param str mtype: spam or ham
+        :return: a list of booleans, in the order of messages
+        """
+        results = [False] * len(messages)
+        if not self._sa_is_local:
+            for index, (rcpt, msg) in enumerate(messages):
+                results[index] = self._learn(rcpt, msg, mtype)
+                if not results[index]:
+                    break
+            return results
+        batch_size = getattr(settings, "AMAVIS_SA_LEARN_BATCH_SIZE", 100)
+        groups = {}
+        for index, (rcpt, msg) in enumerate(messages):
+            groups.setdefault(self._get_username(rcpt), []).append(index)
+        for username, indexes in groups.items():
+            for pos in range(0, len(indexes), batch_size):
+                batch = indexes[pos:pos + batch_size]
+                result = self._learn_group(
+                    username, [messages[index][1] for index in batch], mtype)
+                if not result:
+                    return results
+                for index in batch:
+                    results[index] = True
+        return results
+
     def learn_spam(self, rcpt, msg):
-        """Learn new spam."""
+        """Learn new spam.
+
+        :param msg: message content (str, bytes or an iterable of bytes)
+        """
         return self._learn(rcpt, msg, "spam")
 
     def learn_ham(self, rcpt, msg):
-        """Learn new ham."""
+        """Learn new ham.
+
+        :param msg: message content (str, bytes or an iterable of bytes)
+        """
         return self._learn(rcpt, msg, "ham")
 
     def done(self):
-        """Call this method at the end of the processing."""
-        if self._sa_is_local:
-            for username in self._username_cache:
-                cmd = self._sync_cmd.format(username)
-                exec_cmd(cmd, **self._learn_cmd_kwargs)
+        """Call this method at the end of the processing.
+
+        Databases are synchronized in parallel, running up to
+        AMAVIS_SA_LEARN_CONCURRENCY commands at the same time.
+        """
+        if not self._sa_is_local or not self._username_cache:
+            return
+        concurrency = getattr(settings, "AMAVIS_SA_LEARN_CONCURRENCY", 4)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(
+                lambda username: exec_cmd(
+                    self._sync_cmd.format(username), **self._learn_cmd_kwargs),
+                self._username_cache
+            ))
 
 
 class QuarantineNavigationParameters(NavigationParameters):
@@ -437,3 +683,360 @@ def cleanup_email_address(address):
     if address[0]:
         return "%s <%s>" % address
     return address[1]
+
+
+def get_user_addresses(user):
+    """Return the addresses a simple user receives messages for."""
+    addresses = [user.email]
+    if hasattr(user, "mailbox"):
+        addresses += user.mailbox.alias_addresses
+    return addresses
+
+
+def _get_maddr_lookups(addresses):
+    """Return the lookups matching maddr records of the given addresses.
+
+    :return: a (exact, ranges) tuple, ranges being (prefix, suffix)
+             tuples matching address extensions (local+extension@domain)
+    """
+    delimiter = param_tools.get_global_parameter(
+        "recipient_delimiter", app="modoboa_amavis")
+    exact = set()
+    ranges = set()
+    for address in addresses:
+        query_args = make_query_args(address, exact_extension=False)
+        exact.update(query_args)
+        if not delimiter:
+            continue
+        local_part, domain = split_address(query_args[-1])
+        prefix = "{}{}".format(local_part, delimiter)
+        ranges.add((prefix, "@{}".format(domain)))
+    return sorted(exact), sorted(ranges)
+
+
+def _get_maddr_filter(exact, ranges):
+    """Build a filter matching maddr records of the given lookups.
+
+    Exact addresses are looked up using the index on maddr.email and
+    address extensions using a prefix range. The suffix of ranges is
+    not part of the filter, see :func:`_match_maddr_email`.
+    """
+    flt = Q(email__in=[EncodedValue(address) for address in exact])
+    for prefix, _suffix in ranges:
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        flt |= Q(
+            email__gte=EncodedValue(prefix), email__lt=EncodedValue(upper))
+    return flt
+
+
+def _match_maddr_email(email, exact, ranges):
+    """Check if a maddr.email value matches the given lookups.
+
+    maddr.email is a binary column (except on SQLite) so a LIKE lookup
+    would compare its escaped text representation: the value is
+    compared as bytes encoded using AMAVIS_DEFAULT_DATABASE_ENCODING.
+    """
+    codec = get_database_codec()
+    if isinstance(email, str):
+        email = email.encode(codec, "replace")
+    else:
+        email = bytes(email)
+    for address in exact:
+        try:
+            if email == address.encode(codec):
+                return True
+        except UnicodeEncodeError:
+            continue
+    for prefix, suffix in ranges:
+        try:
+            prefix, suffix = prefix.encode(codec), suffix.encode(codec)
+        except UnicodeEncodeError:
+            continue
+        if email.startswith(prefix) and email.endswith(suffix):
+            return True
+    return False
+
+
+def resolve_maddr_ids(addresses, after=None):
+    """Return the ids of maddr records matching the given addresses.
+
+    :param list addresses: list of addresses (str)
+    :param int after: only consider records with a greater id
+    :return: a set of ids
+    """
+    exact, ranges = _get_maddr_lookups(addresses)
+    qset = Maddr.objects.filter(_get_maddr_filter(exact, ranges))
+    if after is not None:
+        qset = qset.filter(id__gt=after)
+    return {
+        pk for pk, email in qset.values_list("id", "email")
+        if _match_maddr_email(email, exact, ranges)
+    }
+
+
+def get_user_maddr_ids_cache_key(user_pk):
+    """Return the cache key used to store maddr ids of a user."""
+    return "modoboa_amavis:maddr_ids:{}".format(user_pk)
+
+
+def get_user_maddr_ids(user):
+    """Return the ids of maddr records a simple user can access.
+
+    Results are cached per user. As new records are appended to the
+    maddr table when messages for new addresses (or extensions)
+    arrive, cached results are completed with records created since
+    the last resolution.
+    """
+    addresses = get_user_addresses(user)
+    fingerprint = hashlib.md5(
+        smart_bytes(str(_get_maddr_lookups(addresses)))).hexdigest()
+    key = get_user_maddr_ids_cache_key(user.pk)
+    last_id = Maddr.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+    cached = cache.get(key)
+    if cached is None or cached[0] != fingerprint or cached[1] > last_id:
+        ids = resolve_maddr_ids(addresses)
+    elif cached[1] < last_id:
+        ids = cached[2] | resolve_maddr_ids(addresses, after=cached[1])
+    else:
+        return cached[2]
+    cache.set(key, (fingerprint, last_id, ids), 3600)
+    return ids
+
+
+def clear_user_maddr_ids(user_pk):
+    """Remove cached maddr ids of a user."""
+    cache.delete(get_user_maddr_ids_cache_key(user_pk))
+
+
+class MaddrCache(object):
+    """Process-wide LRU cache of maddr records.
+
+    Records are (id, email, domain) tuples, they can be looked up by
+    email or by id. The id of an address never changes as long as its
+    record exists, but ``qcleanup`` removes unreferenced records: a
+    caller finding no row for a cached id must :meth:`discard` the
+    address and resolve it again.
+
+    Records can also be shared between processes using the Django
+    cache (AMAVIS_MADDR_CACHE_TIMEOUT setting, disabled by default).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_email = collections.OrderedDict()
+        self.by_id = {}
+
+    @property
+    def size(self):
+        return getattr(settings, "AMAVIS_MADDR_CACHE_SIZE", 10000)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "AMAVIS_MADDR_CACHE_TIMEOUT", 0)
+
+    @staticmethod
+    def get_email_key(email):
+        return "modoboa_amavis:maddr:email:{}".format(
+            hashlib.md5(smart_bytes(email)).hexdigest())
+
+    @staticmethod
+    def get_id_key(pk):
+        return "modoboa_amavis:maddr:id:{}".format(pk)
+
+    def _store(self, records):
+        """Add records to the local cache, evicting the oldest ones."""
+        with self.lock:
+            for record in records:
+                # Drop entries pointing to a previous id (or email)
+                previous = self.by_email.get(record[1])
+                if previous is not None and previous[0] != record[0]:
+                    self.by_id.pop(previous[0], None)
+                previous = self.by_id.get(record[0])
+                if previous is not None and previous != record[1]:
+                    self.by_email.pop(previous, None)
+                self.by_email[record[1]] = record
+                self.by_email.move_to_end(record[1])
+                self.by_id[record[0]] = record[1]
+            while len(self.by_email) > self.size:
+                email, record = self.by_email.popitem(last=False)
+                self.by_id.pop(record[0], None)
+
+    def add(self, records):
+        """Remember records.
+
+        :param records: an iterable of (id, email, domain) tuples, as
+                        returned by the database
+        :return: the list of records, emails and domains being str
+        """
+        records = [
+            (pk, smart_str(email), smart_str(domain))
+            for pk, email, domain in records
+        ]
+        self._store(records)
+        if records and self.timeout:
+            values = {}
+            for record in records:
+                values[self.get_email_key(record[1])] = record
+                values[self.get_id_key(record[0])] = record
+            cache.set_many(values, self.timeout)
+        return records
+
+    def _get(self, values, field):
+        """Return the records whose field (email or id) is in values."""
+        index = 1 if field == "email" else 0
+        found = {}
+        with self.lock:
+            for value in values:
+                email = value if index else self.by_id.get(value)
+                if email in self.by_email:
+                    self.by_email.move_to_end(email)
+                    found[value] = self.by_email[email]
+        missing = [value for value in values if value not in found]
+        if missing and self.timeout:
+            get_key = self.get_email_key if index else self.get_id_key
+            records = list(
+                cache.get_many([get_key(value) for value in missing])
+                .values()
+            )
+            self._store(records)
+            found.update((record[index], record) for record in records)
+            missing = [value for value in missing if value not in found]
+        if missing:
+            if index:
+                missing = [EncodedValue(value) for value in missing]
+            records = self.add(
+                Maddr.objects.filter(**{"{}__in".format(field): missing})
+                .values_list("id", "email", "domain")
+            )
+            found.update((record[index], record) for record in records)
+        return found
+
+    def get_records(self, emails):
+        """Return the records of the given addresses.
+
+        :param emails: an iterable of addresses (str)
+        :return: a dictionary address -> (id, email, domain), unknown
+                 addresses are missing
+        """
+        return self._get(sorted(set(emails)), "email")
+
+    def get_emails(self, ids):
+        """Return the addresses of the given maddr ids.
+
+        :return: a dictionary id -> address
+        """
+        return {
+            pk: record[1]
+            for pk, record in self._get(sorted(set(ids)), "id").items()
+        }
+
+    def forget(self, records):
+        """Forget records, removed from the database for example.
+
+        :param records: an iterable of (id, email) tuples
+        """
+        records = [(pk, smart_str(email)) for pk, email in records]
+        with self.lock:
+            for pk, email in records:
+                if self.by_id.get(pk) == email:
+                    del self.by_id[pk]
+                if self.by_email.get(email, (None, ))[0] == pk:
+                    del self.by_email[email]
+        if records and self.timeout:
+            cache.delete_many(
+                [self.get_id_key(pk) for pk, email in records] +
+                [self.get_email_key(email) for pk, email in records])
+
+    def discard(self, emails):
+        """Forget the given addresses (and their ids)."""
+        emails = list(emails)
+        with self.lock:
+            records = [
+                self.by_email[email] for email in emails
+                if email in self.by_email
+            ]
+        if emails and self.timeout:
+            records += cache.get_many(
+                [self.get_email_key(email) for email in emails]).values()
+        self.forget((record[0], record[1]) for record in records)
+
+    def clear(self):
+        """Empty the local cache."""
+        with self.lock:
+            self.by_email.clear()
+            self.by_id.clear()
+
+
+maddr_cache = MaddrCache()
+
+
+def reverse_domain_names(domains):
+    """Return a list of reversed domain names."""
+    return [".".join(reversed(domain.split("."))) for domain in domains]
+
+
+def get_admin_domains_cache_key(user_pk):
+    """Return the cache key used to store domains of an administrator."""
+    return "modoboa_amavis:admin_domains:{}".format(user_pk)
+
+
+def get_admin_reversed_domains(user):
+    """Return the reversed names of the domains managed by an admin.
+
+    Amavis stores domain names reversed in maddr.domain. Results are
+    cached per user and cleared when domains or permissions change.
+    """
+    key = get_admin_domains_cache_key(user.pk)
+    domains = cache.get(key)
+    if domains is None:
+        domains = reverse_domain_names(
+            admin_models.Domain.objects.get_for_admin(user)
+            .values_list("name", flat=True)
+        )
+        cache.set(key, domains, 3600)
+    return domains
+
+
+def clear_admin_reversed_domains(user_pk):
+    """Remove cached domains of an administrator."""
+    cache.delete(get_admin_domains_cache_key(user_pk))
+
+
+def get_pending_requests_cache_key(user_pk=None):
+    """Return the cache key used to store the number of pending requests.
+
+    :param int user_pk: id of a domain administrator, None for the
+                        counter shared by super administrators
+    """
+    return "modoboa_amavis:pending_requests:{}".format(
+        "all" if user_pk is None else user_pk)
+
+
+def clear_pending_requests_counter(user_pk=None):
+    """Remove the cached number of pending requests of a user."""
+    cache.delete(get_pending_requests_cache_key(user_pk))
+
+
+def update_pending_requests_counters(domain, delta):
+    """Adjust cached pending requests counters.
+
+    Counters of super administrators and of the administrators of
+    :kw:`domain` are updated, missing ones are left alone.
+
+    :param str domain: reversed domain name (as stored by amavis)
+    :param int delta: number of requests added (or removed if negative)
+    """
+    if not delta:
+        return
+    name = ".".join(reversed(domain.split(".")))
+    keys = [get_pending_requests_cache_key()] + [
+        get_pending_requests_cache_key(user_pk)
+        for user_pk in admin_models.Domain.objects.filter(name=name)
+        .values_list("owners__user", flat=True)
+        if user_pk is not None
+    ]
+    for key in keys:
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            continue
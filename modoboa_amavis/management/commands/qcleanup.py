@@ -9,8 +9,11 @@ from django.core.management.base import BaseCommand
 from django.db.models import Count
 
 from modoboa.parameters import tools as param_tools
+from ...lib import maddr_cache
 from ...models import Maddr, Msgrcpt, Msgs
 from ...modo_extension import Amavis
+from ...sql_connector import clear_listing_cache
+from ...sql_email import clear_message_cache
 
 
 class Command(BaseCommand):
@@ -50,6 +53,7 @@ class Command(BaseCommand):
         ids = Msgrcpt.objects.filter(rs__in=flags).values("mail_id").distinct()
         for msg in Msgs.objects.filter(mail_id__in=ids):
             if not msg.msgrcpt_set.exclude(rs__in=flags).count():
+                clear_message_cache([msg.mail_id])
                 msg.delete()
 
         self.__vprint(
@@ -57,20 +61,22 @@ class Command(BaseCommand):
                 conf["max_messages_age"]))
         limit = int(time.time()) - (conf["max_messages_age"] * 24 * 3600)
         while True:
-            qset = Msgs.objects.filter(
-                pk__in=list(Msgs.objects.filter(time_num__lt=limit).values_list("pk", flat=True)[:5000])
-            )
-            if not qset.exists():
+            ids = list(Msgs.objects.filter(time_num__lt=limit).values_list("pk", flat=True)[:5000])
+            if not ids:
                 break
-            qset.delete()
+            clear_message_cache(ids)
+            Msgs.objects.filter(pk__in=ids).delete()
 
         self.__vprint("Deleting unreferenced e-mail addresses...")
         while True:
             res = Maddr.objects.annotate(
                 msgs_count=Count("msgs"), msgrcpt_count=Count("msgrcpt")
-            ).filter(msgs_count=0, msgrcpt_count=0).values_list("id", flat=True)[:100000]
-            if not res.exists():
+            ).filter(msgs_count=0, msgrcpt_count=0).values_list("id", "email")[:100000]
+            records = list(res)
+            if not records:
                 break
-            Maddr.objects.filter(id__in=list(res)).delete()
+            Maddr.objects.filter(id__in=[pk for pk, email in records]).delete()
+            maddr_cache.forget(records)
 
+        clear_listing_cache()
         self.__vprint("Done.")
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""Management command to create indexes used by the quarantine."""
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Create (or drop) indexes used by the quarantine"  # NOQA:A003
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--drop", action="store_true", default=False,
+            help="Drop indexes instead of creating them")
+        parser.add_argument(
+            "--sql", action="store_true", default=False,
+            help="Only print SQL statements, don't execute them")
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        if not backend.indexes:
+            self.stdout.write(
+                "No index to manage for this database backend.")
+            return
+        connection = connections["amavis"]
+        statements = []
+        with connection.cursor() as cursor:
+            if not options["drop"]:
+                statements += backend.setup_statements
+            for table, name, create, drop in backend.indexes:
+                exists = name in connection.introspection.get_constraints(
+                    cursor, table)
+                if options["drop"] and exists:
+                    statements.append(drop)
+                elif not options["drop"] and not exists:
+                    statements.append(create)
+            for statement in statements:
+                self.stdout.write(statement + ";")
+                if not options["sql"]:
+                    cursor.execute(statement)
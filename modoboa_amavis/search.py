@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Quarantine search backends.
+
+The default backend uses LIKE queries with a leading wildcard, which
+no index can serve. Database specific backends rely on indexes created
+by the ``qindexes`` management command:
+
+* PostgreSQL: trigram (GIN) indexes, searched using ILIKE
+* MySQL: FULLTEXT indexes, searched using MATCH ... AGAINST
+
+The command also creates an index on maddr.email, used when addresses
+are looked up (see :class:`modoboa_amavis.utils.EncodedValue`).
+"""
+
+import functools
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Func, Lookup, Q
+from django.db.models.lookups import IContains
+
+from .utils import ConvertFrom
+
+
+class ILike(Lookup):
+    """Case insensitive LIKE (PostgreSQL only)."""
+
+    lookup_name = "ilike"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return "%s ILIKE %s" % (lhs, rhs), lhs_params + rhs_params
+
+
+class Match(Lookup):
+    """Full text search in boolean mode (MySQL only)."""
+
+    lookup_name = "match"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return (
+            "MATCH (%s) AGAINST (%s IN BOOLEAN MODE)" % (lhs, rhs),
+            lhs_params + rhs_params
+        )
+
+
+class EncodeEscape(Func):
+    """Turn a bytea value into text (PostgreSQL only).
+
+    Contrary to convert_from(), encode() is immutable so it can be
+    used in an index expression.
+    """
+
+    function = "encode"
+    arity = 1
+    template = "%(function)s(%(expressions)s, 'escape')"
+
+
+class SearchBackend:
+    """LIKE based search, works with every database."""
+
+    # List of (table, index name, create statement, drop statement)
+    indexes = []
+    # Statements to execute before creating indexes
+    setup_statements = []
+
+    def get_filter(self, criterion, pattern):
+        """Return a filter on msgrcpt for the given criterion.
+
+        :param str criterion: from_addr, subject or to
+        :param str pattern: the searched string
+        :return: a Q object or None if criterion is unknown
+        """
+        if criterion == "from_addr":
+            return Q(mail__from_addr__icontains=pattern)
+        if criterion == "subject":
+            return Q(mail__subject__icontains=pattern)
+        if criterion == "to":
+            return Q(IContains(ConvertFrom("rid__email"), pattern))
+        return None
+
+
+class PostgreSQLSearchBackend(SearchBackend):
+    """Trigram based search."""
+
+    indexes = [
+        ("msgs", "msgs_subject_trgm_idx",
+         "CREATE INDEX msgs_subject_trgm_idx ON msgs "
+         "USING gin (subject gin_trgm_ops)",
+         "DROP INDEX msgs_subject_trgm_idx"),
+        ("msgs", "msgs_from_addr_trgm_idx",
+         "CREATE INDEX msgs_from_addr_trgm_idx ON msgs "
+         "USING gin (from_addr gin_trgm_ops)",
+         "DROP INDEX msgs_from_addr_trgm_idx"),
+        ("maddr", "maddr_email_trgm_idx",
+         "CREATE INDEX maddr_email_trgm_idx ON maddr "
+         "USING gin ((encode(email, 'escape')) gin_trgm_ops)",
+         "DROP INDEX maddr_email_trgm_idx"),
+        ("maddr", "maddr_email_idx",
+         "CREATE INDEX maddr_email_idx ON maddr (email)",
+         "DROP INDEX maddr_email_idx"),
+    ]
+    setup_statements = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+
+    def get_filter(self, criterion, pattern):
+        """Use ILIKE so trigram indexes can be used."""
+        ops = connections["amavis"].ops
+        pattern = "%{}%".format(ops.prep_for_like_query(pattern))
+        if criterion == "from_addr":
+            return Q(ILike(F("mail__from_addr"), pattern))
+        if criterion == "subject":
+            return Q(ILike(F("mail__subject"), pattern))
+        if criterion == "to":
+            return Q(ILike(EncodeEscape("rid__email"), pattern))
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def mysql_fulltext_enabled():
+    """Check if FULLTEXT indexes are available on the msgs table."""
+    connection = connections["amavis"]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, "msgs")
+    names = [
+        index[1] for index in MySQLSearchBackend.indexes
+        if index[0] == "msgs"
+    ]
+    return all(name in constraints for name in names)
+
+
+class MySQLSearchBackend(SearchBackend):
+    """FULLTEXT based search.
+
+    maddr.email is a binary column which can't be part of a FULLTEXT
+    index so recipient search still relies on LIKE. Full text search
+    matches words (or word prefixes), not arbitrary substrings.
+    """
+
+    indexes = [
+        ("msgs", "msgs_subject_ft_idx",
+         "CREATE FULLTEXT INDEX msgs_subject_ft_idx ON msgs (subject)",
+         "DROP INDEX msgs_subject_ft_idx ON msgs"),
+        ("msgs", "msgs_from_addr_ft_idx",
+         "CREATE FULLTEXT INDEX msgs_from_addr_ft_idx ON msgs (from_addr)",
+         "DROP INDEX msgs_from_addr_ft_idx ON msgs"),
+        ("maddr", "maddr_email_idx",
+         "CREATE INDEX maddr_email_idx ON maddr (email)",
+         "DROP INDEX maddr_email_idx ON maddr"),
+    ]
+
+    # Default value of innodb_ft_min_token_size
+    min_word_length = 3
+
+    def get_boolean_query(self, pattern):
+        """Build a boolean mode query requiring every word of pattern.
+
+        Each word is used as a prefix. Words shorter than the minimum
+        indexed length would never match so None is returned in this
+        case.
+
+        :return: a string or None if pattern can't be used as is
+        """
+        words = re.findall(r"\w+", pattern)
+        if not words or any(
+                len(word) < self.min_word_length for word in words):
+            return None
+        return " ".join("+{}*".format(word) for word in words)
+
+    def get_filter(self, criterion, pattern):
+        """Use MATCH ... AGAINST when possible."""
+        if criterion in ["from_addr", "subject"] and mysql_fulltext_enabled():
+            query = self.get_boolean_query(pattern)
+            if query is not None:
+                return Q(Match(F("mail__{}".format(criterion)), query))
+        return super().get_filter(criterion, pattern)
+
+
+BACKENDS = {
+    "like": SearchBackend,
+    "postgresql": PostgreSQLSearchBackend,
+    "mysql": MySQLSearchBackend,
+}
+
+
+def get_search_backend():
+    """Return the search backend to use.
+
+    It can be forced using the AMAVIS_SEARCH_BACKEND setting (like,
+    postgresql or mysql), otherwise it depends on the database engine.
+    """
+    name = getattr(settings, "AMAVIS_SEARCH_BACKEND", None)
+    if name is None:
+        name = connections["amavis"].vendor
+    return BACKENDS.get(name, SearchBackend)()
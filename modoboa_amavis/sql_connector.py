@@ -2,23 +2,216 @@
 
 """SQL connector module."""
 
+import base64
+import binascii
 import datetime
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import (
+    BinaryField, Exists, F, Max, OuterRef, Q, Value
+)
+from django.db.models.expressions import RawSQL
 
-from django.db.models import Q
-
-from modoboa.admin.models import Domain
 from modoboa.lib.email_utils import decode
+from modoboa.parameters import tools as param_tools
 
-from .lib import cleanup_email_address, make_query_args
-from .models import Maddr, Msgrcpt, Quarantine
+from .lib import (
+    cleanup_email_address, get_admin_reversed_domains,
+    get_pending_requests_cache_key, get_user_maddr_ids, maddr_cache,
+    reverse_domain_names, update_pending_requests_counters
+)
+from .models import Msgrcpt, Msgs, Quarantine
+from .search import get_search_backend
 from .utils import (
-    ConvertFrom, fix_utf8_encoding, smart_bytes, smart_str
+    EncodedValue, fix_utf8_encoding, fix_utf8_encodings, smart_bytes,
+    smart_str
 )
 
 
-def reverse_domain_names(domains):
-    """Return a list of reversed domain names."""
-    return [".".join(reversed(domain.split("."))) for domain in domains]
+ADMIN_DOMAINS_TABLE = "modoboa_amavis_admin_domains"
+
+
+def _load_admin_domains_table(domains):
+    """Store :kw:`domains` into a temporary table.
+
+    The table lives as long as the database session and is only
+    refilled when the list of domains changes. A rollback drops (or
+    empties) the table, so it is only considered loaded once the
+    transaction is committed.
+    """
+    connection = connections["amavis"]
+    fingerprint = hashlib.md5(smart_bytes("\n".join(domains))).hexdigest()
+    loaded = getattr(connection, "_amavis_admin_domains", (None, None))
+    if loaded[0] is connection.connection and loaded[1] == fingerprint:
+        return
+    with connection.cursor() as cursor:
+        # Copy the definition of maddr.domain so charsets match
+        cursor.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS {} AS "
+            "SELECT domain FROM maddr WHERE 1 = 0".format(ADMIN_DOMAINS_TABLE))
+        cursor.execute("DELETE FROM {}".format(ADMIN_DOMAINS_TABLE))
+        cursor.executemany(
+            "INSERT INTO {} (domain) VALUES (%s)".format(ADMIN_DOMAINS_TABLE),
+            [(domain, ) for domain in domains]
+        )
+    marker = (connection.connection, fingerprint)
+
+    def mark_loaded():
+        connection._amavis_admin_domains = marker
+
+    connection._amavis_admin_domains = (None, None)
+    transaction.on_commit(mark_loaded, using="amavis")
+
+
+def get_domains_filter(domains, field="rid__domain"):
+    """Return a filter restricting :kw:`field` to :kw:`domains`.
+
+    Short lists are sent as is. Above the AMAVIS_DOMAINS_IN_LIMIT
+    setting, domains are loaded into a temporary table and a subquery
+    is used instead of a huge IN (...) clause. Set it to None to
+    always send lists.
+
+    :param list domains: reversed domain names
+    """
+    limit = getattr(settings, "AMAVIS_DOMAINS_IN_LIMIT", 500)
+    if limit is None or len(domains) <= limit:
+        return Q(**{"{}__in".format(field): domains})
+    _load_admin_domains_table(domains)
+    return Q(**{"{}__in".format(field): RawSQL(
+        "SELECT domain FROM {}".format(ADMIN_DOMAINS_TABLE), [])})
+
+
+def get_quarantine_filter_strategy():
+    """Return the strategy used to select quarantined messages.
+
+    * subquery: mail_id IN (SELECT mail_id FROM quarantine ...)
+    * exists: correlated EXISTS on the quarantine primary key
+    * quar_type: msgs.quar_type = 'Q', the quarantine table is not read
+
+    exists is used unless the AMAVIS_QUARANTINE_FILTER setting says
+    otherwise. quar_type is cheaper on MySQL (reading the quarantine
+    table, which contains message bodies, is expensive with InnoDB)
+    but it may disagree with the content of the quarantine table.
+    """
+    return getattr(settings, "AMAVIS_QUARANTINE_FILTER", None) or "exists"
+
+
+LISTING_GENERATION_KEY = "modoboa_amavis:listing_generation"
+
+
+def get_listing_generation():
+    """Return the current generation of cached listings.
+
+    If the counter has been evicted, a new one is initialized with the
+    current time so it can't match a previous value.
+    """
+    return cache.get_or_set(LISTING_GENERATION_KEY, time.time_ns(), None)
+
+
+def clear_listing_cache():
+    """Invalidate every cached listing."""
+    try:
+        cache.incr(LISTING_GENERATION_KEY)
+    except ValueError:
+        get_listing_generation()
+
+
+def _encode_cursor_value(value):
+    """Make a sort value JSON serializable."""
+    if isinstance(value, (bytes, memoryview)):
+        return {"b": base64.b64encode(smart_bytes(value)).decode("ascii")}
+    return value
+
+
+def _decode_cursor_value(value):
+    """Reverse of :func:`_encode_cursor_value`."""
+    if isinstance(value, dict):
+        return base64.b64decode(value["b"])
+    return value
+
+
+def encode_cursor(page, order, position):
+    """Build an opaque cursor pointing right after :kw:`position`.
+
+    :param int page: number of the page the cursor leads to
+    :param str order: sort order the position was computed with
+    :param list position: sort values of the last row already displayed
+    :return: a string
+    """
+    payload = json.dumps(
+        [page, order, [_encode_cursor_value(v) for v in position]])
+    return base64.urlsafe_b64encode(payload.encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor, page, order):
+    """Decode a cursor built by :func:`encode_cursor`.
+
+    :return: the position stored in the cursor, or None if the cursor
+             is invalid or does not match :kw:`page` and :kw:`order`
+    """
+    try:
+        cpage, corder, position = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")))
+        position = [_decode_cursor_value(v) for v in position]
+    except (binascii.Error, KeyError, TypeError, UnicodeError, ValueError):
+        return None
+    if cpage != page or corder != order:
+        return None
+    return position
+
+
+class QuarantineRow:
+    """A message of the quarantine listing.
+
+    Values are stored as fetched and derived ones (date and CSS class)
+    are computed on access. Templates can also use item lookups, with
+    the keys of the dictionaries used before (from, class...).
+    """
+
+    __slots__ = (
+        "sender", "to", "subject", "mailid", "time_num", "type", "score",
+        "status"
+    )
+
+    ALIASES = {"from": "sender", "class": "css_class"}
+
+    def __init__(self, sender, to, subject, mailid, time_num, content,
+                 score, status):
+        """Constructor."""
+        self.sender = sender
+        self.to = to
+        self.subject = subject
+        self.mailid = mailid
+        self.time_num = time_num
+        self.type = content
+        self.score = score
+        self.status = status
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.ALIASES.get(key, key))
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return "<QuarantineRow: {} {}>".format(self.mailid, self.to)
+
+    @property
+    def date(self):
+        return datetime.datetime.fromtimestamp(self.time_num)
+
+    @property
+    def css_class(self):
+        if self.status in ["", " "]:
+            return "unseen"
+        if self.status == "p":
+            return "pending"
+        return ""
 
 
 class SQLconnector:
@@ -42,8 +235,22 @@ class SQLconnector:
         "mail__subject",
         "mail__mail_id",
         "mail__time_num",
+        "mail_id",
+        "rseqnum",
+        "rid",
+        "rid__domain",
     ]
 
+    FIELD_INDEX = {
+        field: index for index, field in enumerate(QUARANTINE_FIELDS)
+    }
+
+    # Fields used to break ties between rows sharing the same sort
+    # value. (mail_id, rseqnum) is unique within msgrcpt.
+    TIEBREAKER_FIELDS = ["mail_id", "rseqnum"]
+
+    NULLABLE_ORDER_FIELDS = ["bspam_level"]
+
     def __init__(self, user=None, navparams=None):
         """Constructor."""
         self.user = user
@@ -51,47 +258,42 @@ class SQLconnector:
         self.messages = None
 
         self._messages_count = None
-        self._annotations = {}
-
-    def _exec(self, query, args):
-        """Execute a raw SQL query.
-
-        :param string query: query to execute
-        :param list args: a list of arguments to replace in :kw:`query`
-        """
-        from django.db import connections, transaction
-
-        with transaction.atomic():
-            cursor = connections["amavis"].cursor()
-            cursor.execute(query, args)
+        self.last_position = None
+        # One of "exact", "estimated" or "lower_bound"
+        self.count_mode = "exact"
+        self.quarantine_filter = get_quarantine_filter_strategy()
+        self.search_backend = get_search_backend()
+        self.cache_size = getattr(settings, "AMAVIS_LISTING_CACHE_SIZE", 2000)
+        self.cache_timeout = getattr(
+            settings, "AMAVIS_LISTING_CACHE_TIMEOUT", 300)
+        self._cache_key = None
+        self._cached_listing = None
 
     def _apply_msgrcpt_simpleuser_filter(self, flt):
         """Apply specific filter for simple users."""
-        if "str_email" not in self._annotations:
-            self._annotations["str_email"] = ConvertFrom("rid__email")
-
-        rcpts = [self.user.email]
-        if hasattr(self.user, "mailbox"):
-            rcpts += self.user.mailbox.alias_addresses
-
-        query_rcpts = []
-        for rcpt in rcpts:
-            query_rcpts += make_query_args(rcpt, exact_extension=False,
-                                           wildcard=".*")
-
-        re = "(%s)" % "|".join(query_rcpts)
-        return flt & Q(str_email__regex=re)
+        return flt & Q(rid__in=get_user_maddr_ids(self.user))
 
     def _apply_msgrcpt_filters(self, flt):
         """Apply filters based on user's role."""
         if self.user.role == "SimpleUsers":
             flt = self._apply_msgrcpt_simpleuser_filter(flt)
         elif not self.user.is_superuser:
-            doms = Domain.objects.get_for_admin(
-                self.user).values_list("name", flat=True)
-            flt &= Q(rid__domain__in=reverse_domain_names(doms))
+            flt &= get_domains_filter(get_admin_reversed_domains(self.user))
         return flt
 
+    def _get_quarantined_filter(self):
+        """Return a filter restricting results to quarantined messages."""
+        if self.quarantine_filter == "quar_type":
+            return Q(mail__quar_type="Q")
+        if self.quarantine_filter == "subquery":
+            return Q(mail__in=Quarantine.objects.filter(
+                chunk_ind=1).values("mail_id"))
+        return Q(Exists(Quarantine.objects.filter(
+            partition_tag=OuterRef("partition_tag"),
+            mail=OuterRef("mail"),
+            chunk_ind=1
+        )))
+
     def _get_quarantine_content(self):
         """Fetch quarantine content.
 
@@ -109,16 +311,8 @@ class SQLconnector:
                 criteria = "from_addr,subject,to"
             search_flt = None
             for crit in criteria.split(","):
-                if crit == "from_addr":
-                    nfilter = Q(mail__from_addr__icontains=pattern)
-                elif crit == "subject":
-                    nfilter = Q(mail__subject__icontains=pattern)
-                elif crit == "to":
-                    if "str_email" not in self._annotations:
-                        self._annotations["str_email"] = ConvertFrom(
-                            "rid__email")
-                    nfilter = Q(str_email__icontains=pattern)
-                else:
+                nfilter = self.search_backend.get_filter(crit, pattern)
+                if nfilter is None:
                     continue
                 search_flt = (
                     nfilter if search_flt is None else search_flt | nfilter
@@ -129,115 +323,522 @@ class SQLconnector:
         if msgtype is not None:
             flt &= Q(content=msgtype)
 
-        flt &= Q(
-            mail__in=Quarantine.objects.filter(chunk_ind=1).values("mail_id")
-        )
+        flt &= self._get_quarantined_filter()
 
         return (
             Msgrcpt.objects
-            .annotate(**self._annotations)
             .select_related("mail", "rid")
             .filter(flt)
         )
 
+    def _get_order(self):
+        """Return the active sort order."""
+        return self.navparams.get("order") or "-date"
+
+    def _get_sort_keys(self):
+        """Return the list of (field, descending) tuples used to sort."""
+        order = self._get_order()
+        descending = order[0] == "-"
+        if descending:
+            order = order[1:]
+        fields = (
+            [self.ORDER_TRANSLATION_TABLE[order]] + self.TIEBREAKER_FIELDS)
+        return [(field, descending) for field in fields]
+
+    def _get_ordering(self):
+        """Return the order_by() arguments matching the sort keys."""
+        ordering = []
+        for field, descending in self._get_sort_keys():
+            if field not in self.NULLABLE_ORDER_FIELDS:
+                ordering.append("-" + field if descending else field)
+            elif descending:
+                ordering.append(F(field).desc(nulls_last=True))
+            else:
+                ordering.append(F(field).asc(nulls_first=True))
+        return ordering
+
+    def _get_seek_filter(self, position):
+        """Return a filter selecting rows located after :kw:`position`.
+
+        NULL values are considered lower than anything else, which is
+        consistent with :meth:`_get_ordering`.
+        """
+        flt = Q(pk__in=[])
+        same = Q()
+        for (field, descending), value in zip(
+                self._get_sort_keys(), position):
+            if isinstance(value, (bytes, memoryview)):
+                # Values of binary columns (maddr.email...) must be
+                # compared as bytes, whatever the model field is
+                value = Value(bytes(value), output_field=BinaryField())
+            if value is None:
+                after = (
+                    None if descending
+                    else Q(**{"{}__isnull".format(field): False})
+                )
+                equal = Q(**{"{}__isnull".format(field): True})
+            else:
+                lookup = "lt" if descending else "gt"
+                after = Q(**{"{}__{}".format(field, lookup): value})
+                if descending and field in self.NULLABLE_ORDER_FIELDS:
+                    after |= Q(**{"{}__isnull".format(field): True})
+                equal = Q(**{field: value})
+            if after is not None:
+                flt |= same & after
+            same &= equal
+        return flt
+
+    def _get_position(self, qm):
+        """Return the sort values of a row."""
+        return [
+            qm[self.FIELD_INDEX[field]]
+            for field, descending in self._get_sort_keys()
+        ]
+
+    def _estimate_count(self, qset):
+        """Ask the database planner how many rows :kw:`qset` returns.
+
+        :return: an integer or None if no estimation is available
+        """
+        connection = connections[qset.db]
+        if connection.vendor == "postgresql":
+            prefix = "EXPLAIN (FORMAT JSON) "
+        elif connection.vendor == "mysql":
+            prefix = "EXPLAIN FORMAT=JSON "
+        else:
+            return None
+        # Compile using the connection the query is explained on
+        sql, params = qset.query.get_compiler(using=qset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, (bytes, str)):
+            plan = json.loads(plan)
+        try:
+            if connection.vendor == "postgresql":
+                return int(plan[0]["Plan"]["Plan Rows"])
+            block = plan["query_block"]
+            if "nested_loop" in block:
+                block = block["nested_loop"][-1]
+            return int(block["table"]["rows_produced_per_join"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def _count_messages(self):
+        """Count messages, or estimate their number for big listings.
+
+        Exact counts are always used when a search pattern is
+        provided. Otherwise, counting stops at the configured limit
+        and the database planner is asked for an estimation.
+        """
+        limit = param_tools.get_global_parameter("exact_count_limit")
+        if not limit or self.navparams.get("pattern"):
+            return self.messages.count()
+        qset = self.messages.order_by()
+        count = qset[:limit + 1].count()
+        if count <= limit:
+            return count
+        estimate = self._estimate_count(qset)
+        if estimate is not None and estimate > limit:
+            self.count_mode = "estimated"
+            return estimate
+        self.count_mode = "lower_bound"
+        return limit
+
     def messages_count(self):
         """Return the total number of messages living in the quarantine.
 
-        We also store the built queryset for a later use.
+        The returned value might be an estimation, see
+        :attr:`count_mode`. We also store the built queryset for a
+        later use.
         """
         if self.user is None or self.navparams is None:
             return None
         if self._messages_count is None:
             self.messages = self._get_quarantine_content()
-            self.messages = self.messages.values(*self.QUARANTINE_FIELDS)
+            self.messages = self.messages.values_list(
+                *self.QUARANTINE_FIELDS)
+            self.messages = self.messages.order_by(*self._get_ordering())
+            cached = self._get_cached_listing()
+            if "count" in cached:
+                self._messages_count = cached["count"]
+                self.count_mode = cached["count_mode"]
+            else:
+                self._messages_count = self._count_messages()
+                self._update_cached_listing(
+                    count=self._messages_count, count_mode=self.count_mode)
 
-            order = self.navparams.get("order")
-            if order is not None:
-                sign = ""
-                if order[0] == "-":
-                    sign = "-"
-                    order = order[1:]
-                order = self.ORDER_TRANSLATION_TABLE[order]
-                self.messages = self.messages.order_by(sign + order)
+        return self._messages_count
 
-            self._messages_count = len(self.messages)
+    def _get_quarantine_version(self):
+        """Return a value which changes when new messages arrive.
 
-        return self._messages_count
+        Messages are inserted by amavis, so there is no signal to rely
+        on: we look at the most recent time_num and at the number of
+        messages sharing it. Both are served by the time_num index.
+        """
+        last = Msgs.objects.aggregate(last=Max("time_num"))["last"]
+        if last is None:
+            return None
+        return (last, Msgs.objects.filter(time_num=last).count())
+
+    def _get_scope(self):
+        """Return what the user is allowed to see.
+
+        :return: None (everything), a list of maddr ids (simple users)
+                 or a list of reversed domain names (administrators)
+        """
+        if self.user.role == "SimpleUsers":
+            return sorted(get_user_maddr_ids(self.user))
+        if not self.user.is_superuser:
+            return get_admin_reversed_domains(self.user)
+        return None
+
+    def _get_cache_key(self):
+        """Return the cache key of the current listing.
+
+        It depends on the user and on what they are allowed to see, on the
+        active filters and sort order, on the listing generation and
+        on the quarantine version.
+        """
+        params = [
+            self._get_scope(), self._get_order(), self.quarantine_filter,
+            param_tools.get_global_parameter("exact_count_limit"),
+            get_listing_generation(), self._get_quarantine_version()
+        ]
+        params += [
+            self.navparams.get(name)
+            for name in ["pattern", "criteria", "msgtype", "viewrequests"]
+        ]
+        digest = hashlib.md5(smart_bytes(repr(params))).hexdigest()
+        return "modoboa_amavis:listing:{}:{}".format(self.user.pk, digest)
+
+    def _get_cached_listing(self):
+        """Return the cached data of the current listing.
+
+        It is a dictionary which can contain the number of messages
+        (count and count_mode keys) and the ordered list of the first
+        (mail_id, rseqnum) pairs (ids key).
+        """
+        if self._cached_listing is None:
+            if not self.cache_size:
+                self._cached_listing = {}
+            else:
+                self._cache_key = self._get_cache_key()
+                self._cached_listing = cache.get(self._cache_key) or {}
+        return self._cached_listing
+
+    def _update_cached_listing(self, **values):
+        """Update the cached data of the current listing."""
+        if not self.cache_size:
+            return
+        self._cached_listing.update(values)
+        cache.set(self._cache_key, self._cached_listing, self.cache_timeout)
+
+    def _get_cached_ids(self):
+        """Return the ordered (mail_id, rseqnum) pairs of the listing.
+
+        The first :attr:`cache_size` pairs are fetched using one query
+        and cached, so browsing the first pages does not run the
+        listing query again.
+
+        :return: a list or None if the cache is disabled
+        """
+        if not self.cache_size:
+            return None
+        cached = self._get_cached_listing()
+        if "ids" not in cached:
+            ids = [
+                (smart_bytes(mail_id), rseqnum)
+                for mail_id, rseqnum in self.messages.values_list(
+                    "mail_id", "rseqnum")[:self.cache_size]
+            ]
+            self._update_cached_listing(ids=ids)
+        return cached["ids"]
+
+    def _fetch_ids(self, ids):
+        """Fetch the rows matching a list of (mail_id, rseqnum) pairs.
+
+        Rows are looked up by primary key, still applying the listing
+        filters so a row which does not match them anymore is skipped.
+        """
+        rows = {}
+        qset = self.messages.order_by().filter(
+            mail_id__in=[mail_id for mail_id, rseqnum in ids])
+        mail_id = self.FIELD_INDEX["mail_id"]
+        rseqnum = self.FIELD_INDEX["rseqnum"]
+        for qm in qset:
+            rows[(smart_bytes(qm[mail_id]), qm[rseqnum])] = qm
+        return self._build_rows(rows[key] for key in ids if key in rows)
+
+    def _in_cached_window(self, ids, stop):
+        """Tell if rows up to :kw:`stop` are covered by cached ids."""
+        return stop <= len(ids) or len(ids) < self.cache_size
+
+    def _build_rows(self, messages):
+        """Turn raw rows into :class:`QuarantineRow` instances."""
+        idx = self.FIELD_INDEX
+        messages = list(messages)
+        if messages:
+            self.last_position = self._get_position(messages[-1])
+        messages = [qm for qm in messages if qm[idx["rs"]] != "D"]
+        # Actions on displayed rows won't need to query maddr
+        maddr_cache.add(set(
+            (qm[idx["rid"]], qm[idx["rid__email"]], qm[idx["rid__domain"]])
+            for qm in messages
+        ))
+        subjects = fix_utf8_encodings(
+            [qm[idx["mail__subject"]] for qm in messages])
+        senders = {
+            sender: cleanup_email_address(fix_utf8_encoding(sender))
+            for sender in set(qm[idx["mail__from_addr"]] for qm in messages)
+        }
+        return [
+            QuarantineRow(
+                senders[qm[idx["mail__from_addr"]]],
+                smart_str(qm[idx["rid__email"]]),
+                subject,
+                smart_str(qm[idx["mail__mail_id"]]),
+                qm[idx["mail__time_num"]],
+                qm[idx["content"]],
+                qm[idx["bspam_level"]],
+                qm[idx["rs"]]
+            )
+            for qm, subject in zip(messages, subjects)
+        ]
 
     def fetch(self, start=None, stop=None):
         """Fetch a range of messages from the internal cache."""
-        emails = []
-        for qm in self.messages[start - 1:stop]:
-            if qm["rs"] == "D":
-                continue
-            m = {
-                "from": cleanup_email_address(
-                    fix_utf8_encoding(qm["mail__from_addr"])
-                ),
-                "to": smart_str(qm["rid__email"]),
-                "subject": fix_utf8_encoding(qm["mail__subject"]),
-                "mailid": smart_str(qm["mail__mail_id"]),
-                "date": datetime.datetime.fromtimestamp(qm["mail__time_num"]),
-                "type": qm["content"],
-                "score": qm["bspam_level"],
-                "status": qm["rs"]
-            }
-            if qm["rs"] in ["", " "]:
-                m["class"] = "unseen"
-            elif qm["rs"] == "p":
-                m["class"] = "pending"
-            emails.append(m)
-        return emails
+        if start <= self.cache_size:
+            ids = self._get_cached_ids()
+            if ids is not None and self._in_cached_window(ids, stop):
+                return self._fetch_ids(ids[start - 1:stop])
+        return self._build_rows(self.messages[start - 1:stop])
+
+    def fetch_after(self, position, limit):
+        """Fetch messages located after :kw:`position` (keyset mode).
+
+        Contrary to :meth:`fetch`, no OFFSET is used so the cost of a
+        request does not depend on how deep the user has scrolled.
+
+        :param list position: sort values of the last displayed row
+        :param int limit: maximum number of messages to return
+        """
+        ids = self._get_cached_listing().get("ids")
+        key = (smart_bytes(position[-2]), position[-1])
+        if ids is not None and key in ids:
+            start = ids.index(key) + 1
+            if self._in_cached_window(ids, start + limit):
+                return self._fetch_ids(ids[start:start + limit])
+        return self._build_rows(
+            self.messages.filter(self._get_seek_filter(position))[:limit])
+
+    def get_cursor(self, page):
+        """Return a cursor leading to :kw:`page`, or None."""
+        if self.last_position is None:
+            return None
+        return encode_cursor(page, self._get_order(), self.last_position)
+
+    def parse_cursor(self, cursor, page):
+        """Return the position stored in :kw:`cursor`, or None."""
+        return decode_cursor(cursor, page, self._get_order())
+
+    def _refresh_maddr_records(self, records, addresses):
+        """Resolve again addresses whose cached id matched no row.
+
+        Records may be stale if ``qcleanup`` removed them in the
+        meantime.
+
+        :return: a dictionary containing the records whose id changed
+        """
+        addresses = [address for address in addresses if address in records]
+        if not addresses:
+            return {}
+        maddr_cache.discard(addresses)
+        return {
+            address: record
+            for address, record in maddr_cache.get_records(addresses).items()
+            if record != records[address]
+        }
 
     def get_recipient_message(self, address, mailid):
         """Retrieve a message for a given recipient.
         """
         assert isinstance(address, str), "address should be of type str"
 
-        return Msgrcpt.objects\
-            .annotate(str_email=ConvertFrom("rid__email"))\
-            .get(mail=mailid.encode('ascii'), str_email=address)
+        record = maddr_cache.get_records([address]).get(address)
+        if record is not None:
+            try:
+                return Msgrcpt.objects.select_related("mail").get(
+                    mail=mailid.encode("ascii"), rid=record[0])
+            except Msgrcpt.DoesNotExist:
+                maddr_cache.discard([address])
+        return Msgrcpt.objects.select_related("mail").get(
+            mail=mailid.encode("ascii"), rid__email=EncodedValue(address))
+
+    def get_recipient_messages(self, pairs):
+        """Retrieve the messages of a selection, using a single query.
+
+        Addresses are resolved using the maddr cache.
+
+        :param list pairs: list of (address, mail_id) (str)
+        :return: list of (mail_id, address, secret_id, rs) tuples, in
+                 the order of pairs (unknown pairs are ignored)
+        """
+        pairs = list(pairs)
+        found = {}
+        records = maddr_cache.get_records(address for address, _ in pairs)
+        while records:
+            addresses = {
+                record[0]: address for address, record in records.items()}
+            rows = Msgrcpt.objects.filter(
+                mail__in=sorted({
+                    mailid.encode("ascii") for address, mailid in pairs
+                    if address in records
+                }),
+                rid__in=sorted(addresses)
+            ).values_list("mail_id", "rid", "mail__secret_id", "rs")
+            for mailid, rid, secret_id, rs in rows:
+                found[(addresses[rid], smart_str(mailid))] = (
+                    smart_str(secret_id), rs)
+            records = self._refresh_maddr_records(records, {
+                address for address, mailid in pairs
+                if (address, mailid) not in found
+            })
+        return [
+            (mailid, address) + found[(address, mailid)]
+            for address, mailid in pairs if (address, mailid) in found
+        ]
 
     def set_msgrcpt_status(self, address, mailid: str, status):
         """Change the status (rs field) of a message recipient.
 
         :param string status: status
+        :raises Msgrcpt.DoesNotExist: if the message recipient is unknown
         """
         assert isinstance(address, str), "address should be of type str"
-        addr = (
-            Maddr.objects
-            .annotate(str_email=ConvertFrom("email"))
-            .get(str_email=address)
-        )
-        self._exec(
-            "UPDATE msgrcpt SET rs=%s WHERE mail_id=%s AND rid=%s",
-            [status, mailid.encode("ascii"), addr.id]
-        )
+        if not self.set_msgrcpt_status_bulk([(address, mailid)], status):
+            raise Msgrcpt.DoesNotExist
+
+    def _update_msgrcpt_status(self, pairs, records, status, batch_size,
+                               deltas):
+        """Update the rows of pairs whose address is in records.
+
+        :return: the set of updated pairs
+        """
+        addresses = {
+            record[0]: address for address, record in records.items()}
+        keys = sorted({
+            (mailid.encode("ascii"), records[address][0])
+            for address, mailid in pairs if address in records
+        })
+        updated = set()
+        with transaction.atomic(using="amavis"):
+            cursor = connections["amavis"].cursor()
+            for pos in range(0, len(keys), batch_size):
+                batch = keys[pos:pos + batch_size]
+                condition = "(mail_id, rid) IN ({})".format(
+                    ", ".join(["(%s, %s)"] * len(batch)))
+                params = [value for key in batch for value in key]
+                cursor.execute(
+                    "SELECT mail_id, rid, rs FROM msgrcpt WHERE " + condition,
+                    params)
+                for mailid, rid, rs in cursor.fetchall():
+                    updated.add((addresses[rid], smart_str(mailid)))
+                    delta = (1 if status == "p" else 0) - (rs == "p")
+                    domain = records[addresses[rid]][2]
+                    deltas[domain] = deltas.get(domain, 0) + delta
+                cursor.execute(
+                    "UPDATE msgrcpt SET rs=%s WHERE " + condition,
+                    [status] + params)
+        return updated
+
+    def set_msgrcpt_status_bulk(self, pairs, status, batch_size=500):
+        """Change the status (rs field) of several message recipients.
+
+        Addresses are resolved using the maddr cache, then rows are
+        updated by batches of :kw:`batch_size`, in a single
+        transaction.
+
+        :param list pairs: list of (address, mail_id) (str)
+        :param string status: status
+        :return: the number of updated pairs (unknown ones are ignored)
+        """
+        pairs = list(pairs)
+        records = maddr_cache.get_records(address for address, _ in pairs)
+        if not records:
+            return 0
+        updated = set()
+        deltas = {}
+        while records:
+            updated |= self._update_msgrcpt_status(
+                pairs, records, status, batch_size, deltas)
+            records = self._refresh_maddr_records(records, {
+                address for address, mailid in pairs
+                if (address, mailid) not in updated
+            })
+        clear_listing_cache()
+        for domain, delta in deltas.items():
+            if delta:
+                update_pending_requests_counters(domain, delta)
+        return len(updated)
 
     def get_domains_pending_requests(self, domains):
         """Retrieve pending release requests for a list of domains."""
         return Msgrcpt.objects.filter(
-            rs="p", rid__domain__in=reverse_domain_names(domains))
+            get_domains_filter(reverse_domain_names(domains)), rs="p")
 
     def get_pending_requests(self):
-        """Return the number of requests currently pending."""
-        rq = Q(rs="p")
-        if not self.user.is_superuser:
-            doms = Domain.objects.get_for_admin(self.user)
-            if not doms.exists():
-                return 0
-            doms_q = Q(rid__domain__in=reverse_domain_names(
-                doms.values_list("name", flat=True)))
-            rq &= doms_q
-        return Msgrcpt.objects.filter(rq).count()
+        """Return the number of requests currently pending.
+
+        Counts are cached for a short time (AMAVIS_PENDING_REQUESTS_TIMEOUT
+        setting, 60 seconds by default) and adjusted when requests are
+        created or processed, see :meth:`set_msgrcpt_status`.
+        """
+        if self.user.is_superuser:
+            key = get_pending_requests_cache_key()
+        else:
+            key = get_pending_requests_cache_key(self.user.pk)
+        count = cache.get(key)
+        if count is not None:
+            return count
+        if self.user.is_superuser:
+            count = Msgrcpt.objects.filter(rs="p").count()
+        else:
+            domains = get_admin_reversed_domains(self.user)
+            count = Msgrcpt.objects.filter(
+                get_domains_filter(domains), rs="p"
+            ).count() if domains else 0
+        cache.set(
+            key, count,
+            getattr(settings, "AMAVIS_PENDING_REQUESTS_TIMEOUT", 60))
+        return count
+
+    def iter_mail_content(self, mailid):
+        """Iterate over the raw content of a message.
+
+        Chunks are read in order and yielded as returned by the driver
+        (bytes or memoryview), so a big message is never fully loaded.
+        The first chunk is read alone (it usually contains the header
+        section), the next ones using a server-side cursor (when the
+        database supports it).
+        """
+        qset = (
+            Quarantine.objects.filter(mail=mailid)
+            .order_by("chunk_ind")
+            .values_list("chunk_ind", "mail_text")
+        )
+        first = qset.first()
+        if first is None:
+            return
+        yield first[1]
+        qset = qset.filter(chunk_ind__gt=first[0])
+        for chunk_ind, chunk in qset.iterator(chunk_size=16):
+            yield chunk
 
     def get_mail_content(self, mailid):
         """Retrieve the content of a message."""
-        content_bytes = smart_bytes("").join([
-            smart_bytes(qmail.mail_text)
-            for qmail in Quarantine.objects.filter(
-                    mail=mailid)
-        ])
+        content_bytes = b"".join(self.iter_mail_content(mailid))
         content = decode(
             content_bytes, "utf-8",
             append_to_error=("; mail_id=%s" % smart_str(mailid))
@@ -4,25 +4,112 @@
 An email representation based on a database record.
 """
 
+import multiprocessing
+from email import policy
+from email.parser import BytesFeedParser, BytesHeaderParser
+
 from html2text import HTML2Text
 
+from django.conf import settings
+from django.core.cache import cache
 from django.template.loader import render_to_string
+from django.utils.translation import gettext as _
 
 from modoboa.lib.email_utils import Email
 from .sql_connector import SQLconnector
-from .utils import fix_utf8_encoding, smart_str
+from .utils import (
+    decode_part_content, fix_utf8_encoding, iter_part_content,
+    read_header_section, scan_mime_structure, smart_str
+)
+
+
+def get_message_cache_key(mailid):
+    """Return the cache key used to store a parsed message."""
+    return "modoboa_amavis:message:{}".format(smart_str(mailid))
+
+
+def clear_message_cache(mailids):
+    """Remove parsed messages from the cache."""
+    cache.delete_many([get_message_cache_key(mailid) for mailid in mailids])
+
+
+def html_to_text(html):
+    """Convert an HTML content to text."""
+    h = HTML2Text()
+    h.ignore_tables = True
+    h.images_to_alt = True
+    return h.handle(html)
+
+
+def _html_to_text_worker(html, connection):
+    connection.send(html_to_text(html))
+    connection.close()
+
+
+def html_to_text_with_timeout(html, timeout):
+    """Convert an HTML content to text in a separate process.
+
+    :param int timeout: maximum duration of the conversion (in seconds)
+    :return: the text or None if the conversion didn't finish in time
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_html_to_text_worker, args=(html, writer))
+    process.start()
+    writer.close()
+    try:
+        if reader.poll(timeout):
+            return reader.recv()
+    except EOFError:
+        # The worker died
+        pass
+    finally:
+        process.terminate()
+        process.join()
+        reader.close()
+    return None
 
 
 class SQLemail(Email):
 
-    """The SQL version of the Email class."""
+    """The SQL version of the Email class.
+
+    Parsing results (headers, quarantine reason, HTML to text
+    conversions and rendered bodies) are cached for
+    AMAVIS_MESSAGE_CACHE_TIMEOUT seconds (0 disables the cache). Bodies
+    bigger than AMAVIS_MESSAGE_CACHE_MAX_SIZE characters are not
+    cached.
+    """
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._header_msg = None
+        self._cache_timeout = getattr(
+            settings, "AMAVIS_MESSAGE_CACHE_TIMEOUT", 300)
+        self._cached = {}
+        if self._cache_timeout:
+            self._cached = cache.get(get_message_cache_key(self.mailid), {})
+        if "qtype" in self._cached:
+            self.qtype = self._cached["qtype"]
+            self.qreason = self._cached["qreason"]
+            return
+        self._parse_qreason()
+        self._update_cache(qtype=self.qtype, qreason=self.qreason)
+
+    def _update_cache(self, **values):
+        """Store parsing results into the cache."""
+        self._cached.update(values)
+        if self._cache_timeout:
+            cache.set(
+                get_message_cache_key(self.mailid), self._cached,
+                self._cache_timeout)
+
+    def _parse_qreason(self):
+        """Extract the quarantine reason from X-Amavis-Alert."""
         self.qtype = ""
         self.qreason = ""
 
-        qreason = self.msg["X-Amavis-Alert"]
+        qreason = self.header_msg["X-Amavis-Alert"]
         if qreason:
             if "," in qreason:
                 self.qtype, qreason = qreason.split(",", 1)
@@ -31,17 +118,121 @@ class SQLemail(Email):
                 self.qtype = "BAD HEADER SECTION"
                 qreason = qreason[19:]
 
-            qreason = " ".join([x.strip() for x in qreason.splitlines()])
+            # Folding whitespace is kept by the parser
+            qreason = " ".join(qreason.split())
             self.qreason = qreason
 
+    @staticmethod
+    def _is_displayed(part):
+        """Tell if the body of a part is needed to render the message."""
+        return (
+            part["disposition"] != "attachment" and
+            part["content_type"].split("/")[0] in ["text", "image"]
+        )
+
+    @property
+    def msg(self):
+        """Parse the message while it is read from the database.
+
+        Raw bytes are parsed, parts are decoded using their own
+        charset when rendered. Bodies of parts which are not displayed
+        (attachments) are skipped, the MIME structure of the message
+        is recorded instead.
+        """
+        if self._msg is None:
+            parser = BytesFeedParser(policy=policy.default)
+            structure = scan_mime_structure(
+                self._fetch_message_chunks(), parser.feed,
+                self._is_displayed)
+            self._msg = parser.close()
+            if "structure" not in self._cached:
+                self._update_cache(structure=structure)
+        return self._msg
+
+    @property
+    def header_msg(self):
+        """The message, with its header section only.
+
+        Only the first chunk(s) of the message are read, unless the
+        whole message has already been loaded.
+        """
+        if self._msg is not None:
+            return self._msg
+        if self._header_msg is None:
+            content = read_header_section(self._fetch_message_chunks())
+            self._header_msg = BytesHeaderParser(
+                policy=policy.default).parsebytes(content)
+        return self._header_msg
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = self._cached.get("headers")
+        if self._headers is None:
+            self._headers = [
+                {"name": header,
+                 "value": self.get_header(self.header_msg, header)}
+                for header in self._basic_headers
+            ]
+            self._update_cache(headers=self._headers)
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self._headers = value
+
+    @property
+    def all_headers(self):
+        """Return the list of (name, value) of every header."""
+        if "all_headers" not in self._cached:
+            msg = self.header_msg
+            self._update_cache(all_headers=[
+                (name, self.get_header(msg, name)) for name in msg.keys()
+            ])
+        return self._cached["all_headers"]
+
+    @property
+    def structure(self):
+        """Return the list of leaf parts of the message.
+
+        See :func:`modoboa_amavis.utils.scan_mime_structure`.
+        """
+        if "structure" not in self._cached:
+            self.msg
+        return self._cached["structure"]
+
+    @property
+    def attachment_parts(self):
+        """Return the parts which are not displayed as the body."""
+        return [
+            dict(part, filename=part["filename"] or "part_{}".format(
+                part["number"]))
+            for part in self.structure
+            if part["filename"] or not self._is_displayed(part)
+        ]
+
+    def get_part(self, number):
+        """Return the part identified by number or None."""
+        for part in self.structure:
+            if part["number"] == number:
+                return part
+        return None
+
+    def iter_part_content(self, part):
+        """Read and decode the content of a part, chunk by chunk."""
+        return decode_part_content(
+            iter_part_content(self._fetch_message_chunks(), part),
+            part["encoding"])
+
+    def _fetch_message_chunks(self):
+        return SQLconnector().iter_mail_content(self.mailid)
+
     def _fetch_message(self):
         return SQLconnector().get_mail_content(self.mailid)
 
-    @property
-    def body(self):
-        if self._body is None:
-            super().body
-            self._body = fix_utf8_encoding(self._body)
+    def _render_body(self):
+        """Parse the message and render its body."""
+        body = fix_utf8_encoding(super().body)
 
         # if there's no plain text version available attempt to make one by
         # sanitising the html version. The output isn't always pretty but it
@@ -49,14 +240,64 @@ class SQLemail(Email):
         # if the message is spam or ham.
         if self.dformat == "plain" and not self.contents["plain"] \
                 and self.contents["html"]:
-            h = HTML2Text()
-            h.ignore_tables = True
-            h.images_to_alt = True
-            mail_text = h.handle(self.contents["html"])
             self.contents["plain"] = self._post_process_plain(
-                smart_str(mail_text))
-            self._body = self.viewmail_plain()
-            self._body = fix_utf8_encoding(self._body)
+                self._convert_html())
+            body = fix_utf8_encoding(self.viewmail_plain())
+
+        return body
+
+    def _convert_html(self):
+        """Convert the HTML content to text.
+
+        Contents bigger than AMAVIS_HTML2TEXT_MAX_SIZE characters are
+        truncated. If AMAVIS_HTML2TEXT_TIMEOUT is set, contents bigger
+        than AMAVIS_HTML2TEXT_WORKER_MIN_SIZE characters are converted
+        in a separate process, which is stopped after this timeout.
+        The result is cached, whatever its size.
+        """
+        texts = self._cached.get("html_texts", {})
+        variant = str(int(self.links))
+        if variant in texts:
+            return texts[variant]
+        html = self.contents["html"]
+        max_size = getattr(settings, "AMAVIS_HTML2TEXT_MAX_SIZE", 512 * 1024)
+        truncated = max_size is not None and len(html) > max_size
+        if truncated:
+            html = html[:max_size]
+        timeout = getattr(settings, "AMAVIS_HTML2TEXT_TIMEOUT", None)
+        min_size = getattr(
+            settings, "AMAVIS_HTML2TEXT_WORKER_MIN_SIZE", 64 * 1024)
+        if timeout is not None and len(html) > min_size:
+            text = html_to_text_with_timeout(html, timeout)
+        else:
+            text = html_to_text(html)
+        if text is None:
+            text = _(
+                "This message is too complex to be displayed as text, "
+                "download it to read it."
+            )
+        elif truncated:
+            text = "{}\n\n[...] {}".format(text, _(
+                "This message is too big to be fully displayed, "
+                "download it to read it entirely."
+            ))
+        text = smart_str(text)
+        self._update_cache(html_texts=dict(texts, **{variant: text}))
+        return text
+
+    @property
+    def body(self):
+        if self._body is None:
+            variant = "{}:{}".format(self.dformat, int(self.links))
+            bodies = self._cached.get("bodies", {})
+            body = bodies.get(variant)
+            if body is None:
+                body = self._render_body()
+                max_size = getattr(
+                    settings, "AMAVIS_MESSAGE_CACHE_MAX_SIZE", 1024 * 1024)
+                if len(body) <= max_size:
+                    self._update_cache(bodies=dict(bodies, **{variant: body}))
+            self._body = body
 
         return self._body
 
@@ -65,5 +306,8 @@ class SQLemail(Email):
             "qtype": self.qtype,
             "qreason": self.qreason,
             "headers": self.headers,
+            "mail_id": smart_str(self.mailid),
+            "attachments": self.attachment_parts,
+            "query": kwargs.get("query", ""),
         }
         return render_to_string("modoboa_amavis/mailheaders.html", context)
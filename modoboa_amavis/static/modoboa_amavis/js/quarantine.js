@@ -126,9 +126,26 @@ Quarantine.prototype = {
         var args = Listing.prototype.get_load_page_args.call(this);
 
         args.scroll = true;
+        if (this.cursor) {
+            args.cursor = this.cursor;
+        }
         return args;
     },
 
+    /**
+     * A new page has been received, inject it and remember the
+     * cursor pointing to the next one.
+     *
+     * @param {Object} data - page content
+     * @param {string} direction - scroll direction (up or down)
+     */
+    add_new_page: function(data, direction) {
+        if (direction == "down") {
+            this.cursor = data.cursor;
+        }
+        Listing.prototype.add_new_page.apply(this, arguments);
+    },
+
     /**
      * Calculate the bottom position of the scroll container.
      *
@@ -463,6 +480,7 @@ Quarantine.prototype = {
      * @param {Object} data - ajax call response (JSON)
      */
     listing_cb: function(data) {
+        this.cursor = data.cursor;
         this.update_page(data);
         this.navobj.delparam("rcpt").update();
         this.set_msgtype();
@@ -491,7 +509,39 @@ Quarantine.prototype = {
         if (data.url) {
             this.navobj.parse_string(data.url, true).update(true);
         }
+        if (data.job_url) {
+            this.poll_job(data.job_url);
+        }
         $("body").notify("success", data.message, 2000);
+    },
+
+    /**
+     * Follow the progress of an asynchronous job.
+     *
+     * @param {String} url - job status url
+     */
+    poll_job: function(url) {
+        $.ajax({
+            url: url,
+            global: false,
+            dataType: 'json'
+        }).done($.proxy(function(data) {
+            if (!data.finished) {
+                $("body").notify(
+                    "info", data.done + " / " + data.total, 2000);
+                setTimeout($.proxy(function() {
+                    this.poll_job(url);
+                }, this), 2000);
+                return;
+            }
+            this.navobj.update(true);
+            if (data.failures.length) {
+                $("body").notify("error", data.message + " (" +
+                    data.failures.length + " " + gettext("failures") + ")");
+            } else {
+                $("body").notify("success", data.message, 2000);
+            }
+        }, this));
     }
 };
 
@@ -1,13 +1,21 @@
 """Async tasks."""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
+from rq import get_current_job
+
+from django.conf import settings
 from django.utils.translation import ngettext
 
 from modoboa.core import models as core_models
+from modoboa.lib.exceptions import InternalError
+from modoboa.parameters import tools as param_tools
 
-from .lib import SpamassassinClient
+from .lib import AMrelease, SpamassassinClient, close_pdp_connections
+from .models import Msgs
 from .sql_connector import SQLconnector
+from .utils import smart_str
 
 
 def manual_learning(user_pk: int,
@@ -18,16 +26,16 @@ def manual_learning(user_pk: int,
     user = core_models.User.objects.get(pk=user_pk)
     connector = SQLconnector()
     saclient = SpamassassinClient(user, recipient_db)
-    for item in selection:
-        rcpt, mail_id = item.split()
-        content = connector.get_mail_content(mail_id.encode("ascii"))
-        result = saclient.learn_spam(rcpt, content) if mtype == "spam" \
-            else saclient.learn_ham(rcpt, content)
-        if not result:
-            break
-        connector.set_msgrcpt_status(
-            rcpt, mail_id, mtype[0].upper()
-        )
+    selection = [item.split() for item in selection]
+    results = saclient.learn_many([
+        (rcpt, connector.iter_mail_content(mail_id.encode("ascii")))
+        for rcpt, mail_id in selection
+    ], mtype)
+    processed = [
+        (rcpt, mail_id)
+        for (rcpt, mail_id), result in zip(selection, results) if result
+    ]
+    connector.set_msgrcpt_status_bulk(processed, mtype[0].upper())
     if saclient.error is None:
         saclient.done()
         message = ngettext("%(count)d message processed successfully",
@@ -35,3 +43,96 @@ def manual_learning(user_pk: int,
                            len(selection)) % {"count": len(selection)}
     else:
         message = saclient.error
+
+
+def _get_release_batches(messages, batch_size):
+    """Split messages into batches of about batch_size messages.
+
+    Recipients of a message are never split across batches, so they
+    are released using a single request. Messages keep the order of
+    the selection.
+    """
+    groups = {}
+    for message in messages:
+        groups.setdefault(message[0], []).append(message)
+    batches = []
+    batch = []
+    for group in groups.values():
+        if batch and len(batch) + len(group) > batch_size:
+            batches.append(batch)
+            batch = []
+        batch += group
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _release_batch(conf, messages):
+    try:
+        return AMrelease(conf).release_many(
+            messages, batch_size=len(messages))
+    finally:
+        # Don't leave connections of executor threads open in
+        # long-lived workers.
+        close_pdp_connections()
+
+
+def release_messages(selection: List[str]):
+    """Task to release given selection.
+
+    Messages are released by batches of AMAVIS_RELEASE_BATCH_SIZE, up
+    to AMAVIS_RELEASE_CONCURRENCY batches being sent at the same
+    time. Progress and failures are stored into the job meta data.
+    """
+    job = get_current_job()
+    batch_size = getattr(settings, "AMAVIS_RELEASE_BATCH_SIZE", 50)
+    concurrency = getattr(settings, "AMAVIS_RELEASE_CONCURRENCY", 4)
+    conf = dict(param_tools.get_global_parameters("modoboa_amavis"))
+    connector = SQLconnector()
+    selection = [item.split() for item in selection]
+    secret_ids = dict(
+        (smart_str(mail_id), secret_id)
+        for mail_id, secret_id in Msgs.objects.filter(
+            mail_id__in=[mail_id.encode("ascii") for rcpt, mail_id in selection]
+        ).values_list("mail_id", "secret_id")
+    )
+    progress = {"total": len(selection), "done": 0, "failures": []}
+    messages = []
+    for rcpt, mail_id in selection:
+        if mail_id in secret_ids:
+            messages.append((mail_id, secret_ids[mail_id], rcpt))
+        else:
+            progress["failures"].append({"mail_id": mail_id, "rcpt": rcpt})
+            progress["done"] += 1
+
+    def save_progress():
+        if job is not None:
+            job.meta.update(progress)
+            job.save_meta()
+
+    save_progress()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        batches = {
+            executor.submit(_release_batch, conf, batch): batch
+            for batch in _get_release_batches(messages, batch_size)
+        }
+        for future in as_completed(batches):
+            batch = batches[future]
+            try:
+                results = future.result()
+            except InternalError:
+                results = [False] * len(batch)
+            released = []
+            for (mail_id, secret_id, rcpt), result in zip(batch, results):
+                if result:
+                    released.append((rcpt, mail_id))
+                else:
+                    progress["failures"].append(
+                        {"mail_id": mail_id, "rcpt": rcpt})
+            connector.set_msgrcpt_status_bulk(released, "R")
+            progress["done"] += len(batch)
+            save_progress()
+    count = progress["total"] - len(progress["failures"])
+    return ngettext("%(count)d message released successfully",
+                    "%(count)d messages released successfully",
+                    count) % {"count": count}
@@ -9,8 +9,9 @@ from __future__ import unicode_literals
 from django import template
 from django.template.loader import render_to_string
 from django.urls import reverse
-from django.utils.safestring import mark_safe
-from django.utils.translation import gettext as _
+from django.utils import formats
+from django.utils.html import format_html
+from django.utils.translation import gettext as _, ngettext
 
 from .. import constants, lib
 
@@ -44,6 +45,11 @@ def viewm_menu(user, mail_id, rcpt):
          "class": "btn-default",
          "url": reverse("modoboa_amavis:headers_detail", args=[mail_id]),
          "label": _("View full headers")},
+        {"name": "download",
+         "class": "btn-default",
+         "img": "fa fa-download",
+         "url": reverse("modoboa_amavis:mail_download", args=[mail_id]),
+         "label": _("Download")},
     ]
 
     if lib.manual_learning_enabled(user):
@@ -135,6 +141,23 @@ def msgtype_to_color(msgtype):
 def msgtype_to_html(msgtype):
     """Transform a message type to a bootstrap label."""
     color = constants.MESSAGE_TYPE_COLORS.get(msgtype, "default")
-    return mark_safe(
-        "<span class=\"label label-{}\" title=\"{}\">{}</span>".format(
-            color, constants.MESSAGE_TYPES[msgtype], msgtype))
+    # Content type may be empty or unknown for some msgs rows
+    return format_html(
+        "<span class=\"label label-{}\" title=\"{}\">{}</span>",
+        color, constants.MESSAGE_TYPES.get(msgtype, msgtype), msgtype)
+
+
+@register.simple_tag
+def messages_total(count, count_mode="exact"):
+    """Render the number of messages of a listing.
+
+    :param int count: number of messages
+    :param str count_mode: exact, estimated or lower_bound
+    """
+    value = formats.number_format(count, force_grouping=True)
+    if count_mode == "estimated":
+        return _("about %s messages") % value
+    if count_mode == "lower_bound":
+        return _("%s+ messages") % value
+    return ngettext(
+        "%s message", "%s messages", count) % value
@@ -3,6 +3,7 @@
 """Amavis tests."""
 
 import os
+from unittest import mock
 
 from django.test import override_settings
 from django.urls import reverse
@@ -209,6 +210,44 @@ class ManualLearningTestCase(ModoTestCase):
         result = saclient.learn_spam(rcpt, content)
         self.assertTrue(result)
 
+    def test_learn_many(self):
+        """Check that messages are learnt using a single command."""
+        user = core_models.User.objects.get(username="admin")
+        messages = [
+            (rcpt, factories.SPAM_BODY.format(
+                rcpt=rcpt, sender="spam@evil.corp"))
+            for rcpt in ["user@test.com", "admin@test.com", "user@test.com"]
+        ]
+        saclient = lib.SpamassassinClient(user, "global")
+        with mock.patch.object(
+                saclient, "_exec_learn_cmd",
+                wraps=saclient._exec_learn_cmd) as exec_learn_cmd:
+            results = saclient.learn_many(messages, "spam")
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(exec_learn_cmd.call_count, 1)
+        self.assertIsNone(saclient.error)
+
+    def test_learn_cmd_killed_on_error(self):
+        """Check that the learning command does not outlive a failure."""
+        user = core_models.User.objects.get(username="admin")
+        saclient = lib.SpamassassinClient(user, "global")
+
+        def chunks():
+            yield b"From: spam@evil.corp\n"
+            raise RuntimeError("Cannot read message")
+
+        processes = []
+        popen = lib.subprocess.Popen
+
+        def start(*args, **kwargs):
+            processes.append(popen(*args, **kwargs))
+            return processes[-1]
+
+        with mock.patch.object(lib.subprocess, "Popen", side_effect=start):
+            with self.assertRaises(RuntimeError):
+                saclient._exec_learn_cmd("sleep 30", chunks())
+        self.assertIsNotNone(processes[0].returncode)
+
     def test_delete_catchall_alias(self):
         """Check that Users record is not deleted."""
         self.set_global_parameter("user_level_learning", True)
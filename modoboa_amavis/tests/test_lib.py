@@ -2,10 +2,24 @@
 
 from __future__ import unicode_literals
 
-from django.test import SimpleTestCase
+import socket
+from unittest import mock
 
+from django.core.cache import cache as django_cache
+from django.test import SimpleTestCase, override_settings
+
+from modoboa.admin import factories as admin_factories, models as admin_models
+from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
-from modoboa_amavis.lib import cleanup_email_address, make_query_args
+from modoboa_amavis import factories
+from modoboa_amavis.lib import (
+    AMrelease, cleanup_email_address, close_pdp_connections,
+    MaddrCache, get_admin_reversed_domains, make_query_args, maddr_cache,
+    resolve_maddr_ids
+)
+from modoboa_amavis.models import Maddr
+from modoboa_amavis.sql_connector import SQLconnector
+from modoboa_amavis.utils import smart_str
 
 
 class MakeQueryArgsTests(ModoTestCase):
@@ -78,6 +92,221 @@ class MakeQueryArgsTests(ModoTestCase):
         self.assertEqual(output, expected_output)
 
 
+class ResolveMaddrIdsTests(ModoTestCase):
+
+    """Tests for modoboa_amavis.lib.resolve_maddr_ids()."""
+
+    databases = "__all__"
+
+    def test_resolve_with_extensions(self):
+        """Check that extensions are resolved but not similar addresses."""
+        self.set_global_parameter("localpart_is_case_sensitive", False)
+        self.set_global_parameter("recipient_delimiter", "+")
+        maddrs = [
+            factories.MaddrFactory(email=email) for email in [
+                "user@example.com",
+                "user+foo@example.com",
+                "xuser@example.com",
+                "user@example.org",
+                "user+foo@example.org",
+                "users@example.com",
+            ]
+        ]
+        output = resolve_maddr_ids(["User@example.com"])
+        self.assertEqual(output, {maddrs[0].id, maddrs[1].id})
+        output = resolve_maddr_ids(["user@example.com"], after=maddrs[0].id)
+        self.assertEqual(output, {maddrs[1].id})
+
+    def test_resolve_without_delimiter(self):
+        """Check that extensions are ignored without delimiter."""
+        self.set_global_parameter("localpart_is_case_sensitive", False)
+        self.set_global_parameter("recipient_delimiter", "")
+        maddrs = [
+            factories.MaddrFactory(email=email) for email in [
+                "user@example.com",
+                "user+foo@example.com",
+            ]
+        ]
+        output = resolve_maddr_ids(["user@example.com"])
+        self.assertEqual(output, {maddrs[0].id})
+
+    @override_settings(AMAVIS_DEFAULT_DATABASE_ENCODING="LATIN1")
+    def test_resolve_binary_values(self):
+        """Check that binary values (PostgreSQL, MySQL) are matched."""
+        self.set_global_parameter("localpart_is_case_sensitive", False)
+        self.set_global_parameter("recipient_delimiter", "+")
+        rows = [
+            (1, memoryview(b"user@example.com")),
+            (2, b"user+foo@example.com"),
+            (3, memoryview("user+f\xf3\xf3@example.com".encode("latin-1"))),
+            (4, b"user+foo@example.org"),
+            (5, memoryview(b"user+foo@example.com.org")),
+        ]
+        with mock.patch.object(Maddr.objects, "filter") as flt:
+            flt.return_value.values_list.return_value = rows
+            output = resolve_maddr_ids(["user@example.com"])
+        self.assertEqual(output, {1, 2, 3})
+
+
+class MaddrCacheTests(ModoTestCase):
+
+    """Tests for modoboa_amavis.lib.MaddrCache."""
+
+    databases = "__all__"
+
+    def tearDown(self):
+        maddr_cache.clear()
+        django_cache.clear()
+
+    def test_lookups(self):
+        """Check that records are fetched once and evicted in LRU order."""
+        maddrs = [
+            factories.MaddrFactory(email="user{}@example.com".format(i))
+            for i in range(3)
+        ]
+        cache = MaddrCache()
+        with self.assertNumQueries(1, using="amavis"):
+            records = cache.get_records(
+                ["user0@example.com", "user1@example.com", "unknown@test"])
+            self.assertEqual(
+                records["user0@example.com"],
+                (maddrs[0].id, "user0@example.com", "test.domain"))
+            self.assertNotIn("unknown@test", records)
+            self.assertEqual(
+                cache.get_emails([maddrs[1].id]),
+                {maddrs[1].id: "user1@example.com"})
+        with override_settings(AMAVIS_MADDR_CACHE_SIZE=2):
+            cache.get_records(["user0@example.com"])
+            cache.add([(maddrs[2].id, maddrs[2].email, maddrs[2].domain)])
+        self.assertEqual(
+            list(cache.by_email), ["user0@example.com", "user2@example.com"])
+        self.assertNotIn(maddrs[1].id, cache.by_id)
+
+    def test_replaced_record(self):
+        """Check that entries of a replaced record are dropped."""
+        cache = MaddrCache()
+        cache.add([(1, "user@example.com", "example.com")])
+        cache.add([(2, "user@example.com", "example.com")])
+        self.assertEqual(cache.by_id, {2: "user@example.com"})
+        cache.add([(2, "other@example.com", "example.com")])
+        self.assertEqual(list(cache.by_email), ["other@example.com"])
+
+    @override_settings(AMAVIS_MADDR_CACHE_TIMEOUT=60)
+    def test_shared_cache(self):
+        """Check that discarded records are removed from the shared cache."""
+        maddr = factories.MaddrFactory(email="user@example.com")
+        MaddrCache().add([(maddr.id, maddr.email, maddr.domain)])
+        cache = MaddrCache()
+        with self.assertNumQueries(0, using="amavis"):
+            self.assertEqual(
+                cache.get_emails([maddr.id]), {maddr.id: maddr.email})
+        MaddrCache().discard([maddr.email])
+        self.assertIsNone(django_cache.get(MaddrCache.get_id_key(maddr.id)))
+        self.assertIsNone(
+            django_cache.get(MaddrCache.get_email_key(maddr.email)))
+
+    def test_stale_record(self):
+        """Check that a record removed by qcleanup is resolved again."""
+        msgrcpt = factories.create_spam("user@test.com")
+        pair = (smart_str(msgrcpt.rid.email), smart_str(msgrcpt.mail.mail_id))
+        maddr_cache.add([(msgrcpt.rid.id - 1000, pair[0], "com.test")])
+        self.assertEqual(
+            [row[:2] for row in SQLconnector().get_recipient_messages([pair])],
+            [(pair[1], pair[0])])
+        self.assertEqual(
+            maddr_cache.get_records([pair[0]])[pair[0]][0], msgrcpt.rid.id)
+
+
+class AdminReversedDomainsTests(ModoTestCase):
+
+    """Tests for modoboa_amavis.lib.get_admin_reversed_domains()."""
+
+    databases = "__all__"
+
+    @classmethod
+    def setUpTestData(cls):  # NOQA:N802
+        """Create test data."""
+        super().setUpTestData()
+        admin_factories.populate_database()
+
+    def test_cache_invalidation(self):
+        """Check that cached domains follow permission changes."""
+        admin = core_models.User.objects.get(username="admin@test.com")
+        domain = admin_models.Domain.objects.get(name="test.com")
+        self.assertEqual(get_admin_reversed_domains(admin), ["com.test"])
+        domain.remove_admin(admin)
+        self.assertEqual(get_admin_reversed_domains(admin), [])
+        domain.add_admin(admin)
+        self.assertEqual(get_admin_reversed_domains(admin), ["com.test"])
+        domain.name = "test.org"
+        domain.save()
+        self.assertEqual(get_admin_reversed_domains(admin), ["org.test"])
+
+
+@mock.patch("socket.socket")
+class AMreleaseTests(ModoTestCase):
+
+    """Tests for modoboa_amavis.lib.AMrelease."""
+
+    def tearDown(self):
+        close_pdp_connections()
+
+    def test_keep_alive(self, mock_socket):
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250%202.0.0%20Ok\r\n\r\n")
+        self.assertTrue(AMrelease().sendreq("mailid", "secret", "a@b.c"))
+        self.assertTrue(AMrelease().sendreq("mailid", "secret", "a@b.c"))
+        self.assertEqual(mock_socket.call_count, 1)
+
+    def test_release_many(self, mock_socket):
+        mock_socket.return_value.recv.side_effect = [
+            b"setreply=250 2.0.0 Ok\r\n\r\nsetreply=",
+            b"450 4.5.0 Failure\r\n",
+            b"\r\nsetreply=250 2.0.0 Ok\r\n\r\n",
+        ]
+        messages = [
+            ("mailid{}".format(i), "secret", "a@b.c") for i in range(3)]
+        self.assertEqual(
+            AMrelease().release_many(messages), [True, False, True])
+        self.assertEqual(mock_socket.return_value.sendall.call_count, 1)
+        request = mock_socket.return_value.sendall.call_args[0][0]
+        self.assertEqual(request.count(b"request=release\n"), 3)
+
+    def test_release_recipients(self, mock_socket):
+        mock_socket.return_value.recv.side_effect = [
+            b"setreply=250 2.0.0 Ok\r\n\r\n",
+            b"setreply=450 4.5.0 Failure\r\n\r\n",
+        ]
+        messages = [
+            ("mailid1", "secret", "a@b.c"),
+            ("mailid2", "secret", "a@b.c"),
+            ("mailid1", "secret", "d@b.c"),
+        ]
+        self.assertEqual(
+            AMrelease().release_many(messages), [True, False, True])
+        request = mock_socket.return_value.sendall.call_args[0][0]
+        self.assertEqual(request.count(b"request=release\n"), 2)
+        self.assertIn(
+            b"mail_id=mailid1\nsecret_id=secret\nquar_type=Q\n"
+            b"recipient=a@b.c\nrecipient=d@b.c\n\n", request)
+
+    def test_stale_connection(self, mock_socket):
+        stale = mock.Mock()
+        stale.recv.return_value = b""
+        fresh = mock.Mock()
+        fresh.recv.return_value = b"setreply=250 2.0.0 Ok\r\n\r\n"
+        mock_socket.side_effect = [stale, fresh]
+        AMrelease()
+        self.assertTrue(AMrelease().sendreq("mailid", "secret", "a@b.c"))
+        stale.close.assert_called_once_with()
+        fresh.sendall.assert_called_once()
+
+    def test_connection_error(self, mock_socket):
+        mock_socket.return_value.recv.side_effect = socket.timeout
+        self.assertFalse(AMrelease().sendreq("mailid", "secret", "a@b.c"))
+        mock_socket.return_value.close.assert_called_once_with()
+
+
 class FixUTF8EncodingTests(SimpleTestCase):
 
     """Tests for modoboa_amavis.lib.cleanup_email_address()."""
@@ -2,13 +2,17 @@
 
 """Management commands tests."""
 
+from io import StringIO
+
 from dateutil.relativedelta import relativedelta
 
+from django.core.cache import cache
 from django.core.management import call_command
 from django.utils import timezone
 
 from modoboa.lib.tests import ModoTestCase
 from .. import factories, models
+from ..sql_email import SQLemail, get_message_cache_key
 
 
 class ManagementCommandTestCase(ModoTestCase):
@@ -44,3 +48,27 @@ class ManagementCommandTestCase(ModoTestCase):
         call_command("qcleanup")
         with self.assertRaises(models.Msgrcpt.DoesNotExist):
             msgrcpt.refresh_from_db()
+
+    def test_qcleanup_message_cache(self):
+        """Check that qcleanup drops cached messages."""
+        msgrcpt = factories.create_spam("user@test.com", rs="D")
+        key = get_message_cache_key(msgrcpt.mail.mail_id)
+        headers = SQLemail(msgrcpt.mail.mail_id).all_headers
+        self.assertIn(("X-Spam-Flag", "YES"), headers)
+        self.assertEqual(cache.get(key)["all_headers"], headers)
+        call_command("qcleanup")
+        self.assertIsNone(cache.get(key))
+
+    def test_qindexes(self):
+        """Test qindexes command."""
+        out = StringIO()
+        call_command("qindexes", stdout=out)
+        self.assertIn("No index to manage", out.getvalue())
+
+        out = StringIO()
+        with self.settings(AMAVIS_SEARCH_BACKEND="postgresql"):
+            call_command("qindexes", "--sql", stdout=out)
+        output = out.getvalue()
+        self.assertIn("CREATE EXTENSION IF NOT EXISTS pg_trgm;", output)
+        self.assertIn("CREATE INDEX msgs_subject_trgm_idx", output)
+        self.assertIn("CREATE INDEX maddr_email_idx ON maddr (email);", output)
@@ -3,8 +3,11 @@
 """Tests for sql_email."""
 
 import os
+import time
+from unittest import mock
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.utils.encoding import smart_str
 
 from ..sql_email import SQLemail
@@ -24,6 +27,9 @@ class EmailTestImplementation(SQLemail):
 
         return mail_text
 
+    def _fetch_message_chunks(self):
+        yield self._fetch_message()
+
 
 class EmailTests(TestCase):
     """Tests for modoboa_amavis.sql_email.SQLEmail
@@ -48,6 +54,9 @@ class EmailTests(TestCase):
 
         return mail_text
 
+    def tearDown(self):
+        cache.clear()
+
     def _test_email(self, message_id, **kwargs):
         """Boiler plate code for testing e-mails."""
         expected_output = self._get_expected_output(message_id, **kwargs)
@@ -61,7 +70,52 @@ class EmailTests(TestCase):
                          "Non-encoded non-ASCII data (and not UTF-8) (char 85 "
                          "hex): Subject: I think I saw you in my dreams\\x{85}")
 
+    def test_header_section_only(self):
+        """Check that headers are the same when the body is not read."""
+        content = (
+            b"From: sender@example.com\r\n"
+            b"Subject: Caf\xe9 \xe0 emporter\r\n"
+            b"X-Amavis-Alert: BAD HEADER SECTION, Non-encoded non-ASCII\r\n"
+            b"\t data\r\n"
+            b"\r\n"
+            b"Body\r\n"
+        )
+        with mock.patch.object(
+                EmailTestImplementation, "_fetch_message_chunks",
+                return_value=[content]):
+            header_only = EmailTestImplementation("raw")
+            full = EmailTestImplementation("raw")
+            headers = [
+                (name, header_only.get_header(header_only.header_msg, name))
+                for name in header_only.header_msg.keys()
+            ]
+            self.assertEqual(headers, [
+                (name, full.get_header(full.msg, name))
+                for name in full.msg.keys()
+            ])
+        self.assertEqual(header_only.qreason, "Non-encoded non-ASCII data")
+
     def test_email_multipart_with_no_text(self):
         """for a multipart message without a text/plain part convert the
            text/html to text/plain"""
         self._test_email("quarantined")
+
+    @override_settings(AMAVIS_HTML2TEXT_MAX_SIZE=200)
+    def test_html_to_text_truncated(self):
+        output = EmailTestImplementation("quarantined", dformat="plain").body
+        self.assertIn("too big to be fully displayed", output)
+        self.assertLess(len(output), 500)
+
+    @override_settings(
+        AMAVIS_HTML2TEXT_TIMEOUT=30, AMAVIS_HTML2TEXT_WORKER_MIN_SIZE=0)
+    def test_html_to_text_worker(self):
+        output = EmailTestImplementation("quarantined", dformat="plain").body
+        self.assertIn("Click here to Verify your ID", output)
+
+    @override_settings(
+        AMAVIS_HTML2TEXT_TIMEOUT=0.1, AMAVIS_HTML2TEXT_WORKER_MIN_SIZE=0)
+    @mock.patch("modoboa_amavis.sql_email.html_to_text")
+    def test_html_to_text_timeout(self, html_to_text):
+        html_to_text.side_effect = lambda html: time.sleep(10)
+        output = EmailTestImplementation("quarantined", dformat="plain").body
+        self.assertIn("too complex to be displayed as text", output)
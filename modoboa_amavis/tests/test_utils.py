@@ -2,9 +2,15 @@
 
 from __future__ import unicode_literals
 
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase, override_settings
 
-from modoboa_amavis.utils import fix_utf8_encoding
+from modoboa_amavis.factories import VIRUS_BODY, MaddrFactory
+from modoboa_amavis.models import Maddr
+from modoboa_amavis.utils import (
+    EncodedValue, decode_part_content, fix_utf8_encoding, fix_utf8_encodings,
+    get_database_codec, iter_part_content, message_from_chunks,
+    read_header_section, scan_mime_structure, smart_bytes
+)
 
 
 class FixUTF8EncodingTests(SimpleTestCase):
@@ -22,3 +28,144 @@ class FixUTF8EncodingTests(SimpleTestCase):
         expected_output = "\xf0\x9f\x99"
         output = fix_utf8_encoding(value)
         self.assertEqual(output, expected_output)
+
+    def test_ascii(self):
+        value = "Buy cheap stuff\\u20ac"
+        output = fix_utf8_encoding(value)
+        self.assertIs(output, value)
+
+    def test_already_decoded(self):
+        value = "Price: 10\u20ac"
+        output = fix_utf8_encoding(value)
+        self.assertEqual(output, value)
+
+    def test_batch(self):
+        values = ["\xf0\x9f\x99\x88", "", "abc", "\xf0\x9f\x99\x88"]
+        expected_output = ["\U0001f648", "", "abc", "\U0001f648"]
+        output = fix_utf8_encodings(values)
+        self.assertEqual(output, expected_output)
+
+    def test_latin1_range(self):
+        """utf-8 bytes read as latin-1 characters are decoded."""
+        value = "Caf\xc3\xa9 \xc3\xa0 emporter"
+        output = fix_utf8_encoding(value)
+        self.assertEqual(output, "Caf\xe9 \xe0 emporter")
+
+    def test_above_latin1_range(self):
+        """Strings with characters above U+00FF are returned as is.
+
+        Such strings used to be re-encoded with raw_unicode_escape, which
+        turned these characters into \\uXXXX escapes.
+        """
+        value = "Caf\xc3\xa9: 10\u20ac"
+        output = fix_utf8_encoding(value)
+        self.assertIs(output, value)
+
+
+class MessageFromChunksTests(SimpleTestCase):
+
+    """Tests for modoboa_amavis.utils.message_from_chunks()."""
+
+    def test_split_character(self):
+        content = (
+            "Subject: Café\nContent-Type: text/plain; charset=utf-8\n\n"
+            "Café\n"
+        ).encode("utf-8")
+        cut = content.index(b"\xa9")
+        chunks = [content[:cut], memoryview(content[cut:])]
+        output = message_from_chunks(chunks)
+        self.assertEqual(output["Subject"], "Café")
+        self.assertEqual(output.get_content(), "Café\n")
+
+    def test_8bit_part(self):
+        chunks = [
+            b"Content-Type: text/plain; charset=iso-8859-1\n",
+            b"Content-Transfer-Encoding: 8bit\n\nCaf\xe9\n"
+        ]
+        output = message_from_chunks(chunks)
+        self.assertEqual(output.get_content(), "Caf\xe9\n")
+
+
+class ReadHeaderSectionTests(SimpleTestCase):
+
+    """Tests for modoboa_amavis.utils.read_header_section()."""
+
+    def test_stop_at_blank_line(self):
+        def chunks():
+            yield b"Subject: test\r\n"
+            yield memoryview(b"\r\nbody")
+            raise AssertionError("body read")
+
+        output = read_header_section(chunks())
+        self.assertEqual(output, b"Subject: test\r\n\r\n")
+
+    def test_no_body(self):
+        output = read_header_section([b"Subject: test\n"])
+        self.assertEqual(output, b"Subject: test\n")
+
+
+class ScanMimeStructureTests(SimpleTestCase):
+
+    """Tests for modoboa_amavis.utils.scan_mime_structure()."""
+
+    def setUp(self):
+        content = smart_bytes(VIRUS_BODY)
+        self.chunks = [
+            content[pos:pos + 16] for pos in range(0, len(content), 16)]
+
+    def test_structure(self):
+        parts = scan_mime_structure(self.chunks)
+        self.assertEqual(
+            [(part["number"], part["content_type"], part["filename"])
+             for part in parts],
+            [("1", "text/plain", None),
+             ("2", "application/x-msdos-program", "eicar.com")]
+        )
+        content = b"".join(
+            decode_part_content(
+                iter_part_content(self.chunks, parts[1]),
+                parts[1]["encoding"])
+        )
+        self.assertEqual(
+            content,
+            b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE"
+            b"!$H+H*\n"
+        )
+
+    def test_skip_body(self):
+        output = []
+        scan_mime_structure(
+            self.chunks, output.append,
+            lambda part: part["content_type"] == "text/plain")
+        msg = message_from_chunks(output)
+        parts = msg.get_payload()
+        self.assertIn("virus test message", parts[0].get_content())
+        self.assertEqual(parts[1].get_filename(), "eicar.com")
+        self.assertEqual(parts[1].get_payload(), "")
+
+    def test_single_part(self):
+        parts = scan_mime_structure([b"Subject: test\n", b"\nbody\n"])
+        self.assertEqual(parts[0]["number"], "1")
+        self.assertEqual(parts[0]["offset"], 15)
+        self.assertEqual(parts[0]["size"], 5)
+
+
+class EncodedValueTests(TestCase):
+
+    """Tests for modoboa_amavis.utils.EncodedValue."""
+
+    databases = "__all__"
+
+    def test_lookup(self):
+        maddr = MaddrFactory(email="user@example.com")
+        self.assertEqual(
+            Maddr.objects.get(email=EncodedValue("user@example.com")).id,
+            maddr.id)
+        self.assertFalse(Maddr.objects.filter(
+            email__in=[EncodedValue("other@example.com")]).exists())
+
+    def test_database_codec(self):
+        with override_settings(AMAVIS_DEFAULT_DATABASE_ENCODING="LATIN1"):
+            self.assertEqual(get_database_codec(), "iso8859-1")
+        with override_settings(AMAVIS_DEFAULT_DATABASE_ENCODING="WIN1252"):
+            self.assertEqual(get_database_codec(), "cp1252")
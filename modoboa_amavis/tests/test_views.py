@@ -8,17 +8,25 @@ from unittest import mock
 from rq import SimpleWorker
 
 from django.core import mail
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import connections, transaction
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 import django_rq
 
 from modoboa.admin import factories as admin_factories
+from modoboa.admin.models import Domain
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
-from .. import factories
-from ..utils import smart_str
+from .. import factories, models, tasks
+from ..lib import close_pdp_connections, maddr_cache
+from ..sql_connector import (
+    SQLconnector, clear_listing_cache, encode_cursor, get_domains_filter
+)
+from ..utils import smart_bytes, smart_str
 
 
 class TestDataMixin(object):
@@ -47,6 +55,9 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         """Restore msgrcpt state."""
         self.msgrcpt.rs = " "
         self.msgrcpt.save(update_fields=["rs"])
+        cache.clear()
+        maddr_cache.clear()
+        close_pdp_connections()
         self.set_global_parameter("domain_level_learning", False)
         self.set_global_parameter("user_level_learning", False)
 
@@ -59,10 +70,25 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         url = reverse("modoboa_amavis:_mail_list")
         response = self.ajax_get(url)
         self.assertIn("user@test.com", response["listing"])
+        self.assertIn("class=\"openable unseen\"", response["listing"])
+
+        self.msgrcpt.rs = "R"
+        self.msgrcpt.save(update_fields=["rs"])
+        clear_listing_cache()
+        response = self.ajax_get(url)
+        self.assertIn("class=\"openable \"", response["listing"])
 
         response = self.ajax_get("{}?pattern=pouet&criteria=both".format(url))
         self.assertIn("Empty quarantine", response["listing"])
 
+        response = self.ajax_get(
+            "{}?pattern=message&criteria=subject".format(url))
+        self.assertIn("user@test.com", response["listing"])
+
+        response = self.ajax_get(
+            "{}?pattern=user@test&criteria=to".format(url))
+        self.assertIn("user@test.com", response["listing"])
+
         msgrcpt = factories.create_virus("user@test.com")
         response = self.ajax_get("{}?msgtype=V".format(url))
         self.assertIn(
@@ -72,6 +98,224 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
             "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id)),
             response["listing"])
 
+    def test_listing_page_cursor(self):
+        """Test listing pagination using a cursor."""
+        admin = core_models.User.objects.get(username="admin")
+        admin.parameters.set_value(
+            "messages_per_page", 1, app="modoboa_amavis")
+        admin.save()
+        msgrcpt = factories.create_spam("user@test.com")
+        rows = [
+            "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id)),
+            "<tr id=\"{}\">".format(smart_str(msgrcpt.mail.mail_id)),
+        ]
+        url = reverse("modoboa_amavis:_mail_list")
+        response = self.ajax_get(url)
+        self.assertEqual(response["pages"], [1])
+        first = [row for row in rows if row in response["listing"]]
+        self.assertEqual(len(first), 1)
+
+        url = reverse("modoboa_amavis:mail_page")
+        response = self.ajax_get(
+            "{}?page=2&cursor={}".format(url, response["cursor"]))
+        self.assertEqual(response["pages"], [2])
+        self.assertNotIn(first[0], response["rows"])
+        second = [row for row in rows if row in response["rows"]]
+        self.assertEqual(len(second), 1)
+
+        # An invalid cursor falls back to the regular pagination
+        response = self.ajax_get("{}?page=2&cursor=pouet".format(url))
+        self.assertIn(second[0], response["rows"])
+
+    @override_settings(AMAVIS_LISTING_CACHE_SIZE=0)
+    def test_listing_cursor_sort_by_recipient(self):
+        """Test cursors of a listing sorted by recipient."""
+        admin = core_models.User.objects.get(username="admin")
+        msgrcpts = [self.msgrcpt] + [
+            factories.create_spam(rcpt)
+            for rcpt in ["user@test.com", "admin@test.com", "admin@test.com"]
+        ]
+        expected = [
+            smart_str(mail_id) for rcpt, mail_id in sorted(
+                (msgrcpt.rid.email, smart_bytes(msgrcpt.mail.mail_id))
+                for msgrcpt in msgrcpts)
+        ]
+        navparams = {"order": "to", "page": 1}
+        connector = SQLconnector(user=admin, navparams=navparams)
+        connector.messages_count()
+        mail_ids = [row.mailid for row in connector.fetch(1, 1)]
+        for page in range(2, 6):
+            cursor = connector.get_cursor(page)
+            navparams["page"] = page
+            connector = SQLconnector(user=admin, navparams=navparams)
+            connector.messages_count()
+            position = connector.parse_cursor(cursor, page)
+            mail_ids += [
+                row.mailid for row in connector.fetch_after(position, 1)]
+        self.assertEqual(mail_ids, expected)
+
+        # maddr.email is a binary column on PostgreSQL and MySQL
+        cursor = encode_cursor(
+            page, "to", [b"user@test.com", b"mailid", 1])
+        position = connector.parse_cursor(cursor, page)
+        qset = connector.messages.filter(
+            connector._get_seek_filter(position))
+        params = qset.query.sql_with_params()[1]
+        self.assertIn(b"user@test.com", [
+            bytes(param) for param in params
+            if isinstance(param, (bytes, memoryview))
+        ])
+        self.assertNotIn("b'user@test.com'", params)
+
+    def test_listing_count_limit(self):
+        """Test listing of a quarantine bigger than the count limit."""
+        msgrcpt = factories.create_spam("user@test.com")
+        url = reverse("modoboa_amavis:_mail_list")
+        response = self.ajax_get(url)
+        self.assertIn("2 messages", response["listing"])
+
+        self.set_global_parameter("exact_count_limit", 1)
+        response = self.ajax_get(url)
+        self.assertIn("1+ messages", response["listing"])
+        for mrcpt in [self.msgrcpt, msgrcpt]:
+            self.assertIn(
+                "<tr id=\"{}\">".format(smart_str(mrcpt.mail.mail_id)),
+                response["listing"])
+
+    def test_listing_cache(self):
+        """Test listing cache and its invalidation."""
+        url = reverse("modoboa_amavis:_mail_list")
+        row = "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id))
+        with mock.patch.object(
+                SQLconnector, "_count_messages", autospec=True,
+                side_effect=SQLconnector._count_messages) as count:
+            response = self.ajax_get(url)
+            self.assertIn(row, response["listing"])
+            response = self.ajax_get(url)
+            self.assertIn(row, response["listing"])
+            self.assertEqual(count.call_count, 1)
+
+            # A new message invalidates the cache
+            msgrcpt = factories.create_spam("user@test.com")
+            response = self.ajax_get(url)
+            self.assertEqual(count.call_count, 2)
+            self.assertIn("2 messages", response["listing"])
+            self.assertIn(
+                "<tr id=\"{}\">".format(smart_str(msgrcpt.mail.mail_id)),
+                response["listing"])
+
+            # So does a status change
+            SQLconnector().set_msgrcpt_status(
+                smart_str(self.msgrcpt.rid.email),
+                smart_str(self.msgrcpt.mail.mail_id), "D")
+            response = self.ajax_get(url)
+            self.assertEqual(count.call_count, 3)
+            self.assertIn("1 message", response["listing"])
+            self.assertNotIn(row, response["listing"])
+
+    def test_listing_domain_admin(self):
+        """Test listing as a domain administrator."""
+        admin = core_models.User.objects.get(username="admin@test.com")
+        self.client.force_login(admin)
+        url = reverse("modoboa_amavis:_mail_list")
+        for limit in [None, 0]:
+            clear_listing_cache()
+            with self.settings(AMAVIS_DOMAINS_IN_LIMIT=limit):
+                response = self.ajax_get(url)
+            self.assertIn(
+                "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id)),
+                response["listing"])
+
+        # Cached listings follow permission changes
+        domain = Domain.objects.get(name="test.com")
+        domain.remove_admin(admin)
+        response = self.ajax_get(url)
+        self.assertNotIn(
+            "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id)),
+            response["listing"])
+        self.assertNotIn("1 message", response["listing"])
+
+    def test_listing_domain_admin_rollback(self):
+        """Check that the domains table is reloaded after a rollback."""
+        with self.settings(AMAVIS_DOMAINS_IN_LIMIT=0):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic(using="amavis"):
+                    get_domains_filter(["com.test"])
+                    raise RuntimeError
+            flt = get_domains_filter(["com.test"])
+            self.assertTrue(
+                models.Msgrcpt.objects.filter(flt, pk=self.msgrcpt.pk).exists())
+
+    def test_pending_requests_counter(self):
+        """Test the cached number of pending requests."""
+        connectors = [
+            SQLconnector(user=core_models.User.objects.get(username=username))
+            for username in ["admin", "admin@test.com", "admin@test2.com"]
+        ]
+        for connector in connectors:
+            self.assertEqual(connector.get_pending_requests(), 0)
+        rcpt = smart_str(self.msgrcpt.rid.email)
+        mail_id = smart_str(self.msgrcpt.mail.mail_id)
+        connectors[0].set_msgrcpt_status(rcpt, mail_id, "p")
+        for connector, count in zip(connectors, [1, 1, 0]):
+            self.assertEqual(connector.get_pending_requests(), count)
+        connectors[0].set_msgrcpt_status(rcpt, mail_id, "R")
+        for connector in connectors:
+            self.assertEqual(connector.get_pending_requests(), 0)
+
+    def test_set_msgrcpt_status_bulk(self):
+        """Test status updates of several message recipients."""
+        msgrcpts = [self.msgrcpt] + [
+            factories.create_spam(rcpt)
+            for rcpt in ["user@test.com", "admin@test.com"]
+        ]
+        connector = SQLconnector(
+            user=core_models.User.objects.get(username="admin"))
+        self.assertEqual(connector.get_pending_requests(), 0)
+        pairs = [
+            (smart_str(msgrcpt.rid.email), smart_str(msgrcpt.mail.mail_id))
+            for msgrcpt in msgrcpts
+        ]
+        count = connector.set_msgrcpt_status_bulk(
+            pairs + [("unknown@test.com", pairs[0][1])], "p", batch_size=2)
+        self.assertEqual(count, 3)
+        for msgrcpt in msgrcpts:
+            msgrcpt.refresh_from_db()
+            self.assertEqual(msgrcpt.rs, "p")
+        self.assertEqual(connector.get_pending_requests(), 3)
+        connector.set_msgrcpt_status_bulk(pairs[1:], "D")
+        self.assertEqual(connector.get_pending_requests(), 1)
+        with self.assertRaises(models.Msgrcpt.DoesNotExist):
+            connector.set_msgrcpt_status(pairs[0][0], "unknownid", "D")
+
+    def test_listing_quarantine_filters(self):
+        """Test the strategies used to select quarantined messages."""
+        msgrcpt = factories.MsgrcptFactory(
+            rs=" ", rid__email="user@test.com", content="S",
+            mail__quar_type="Q")
+        url = reverse("modoboa_amavis:_mail_list")
+        for strategy in ["subquery", "exists", "quar_type"]:
+            with self.settings(AMAVIS_QUARANTINE_FILTER=strategy):
+                response = self.ajax_get(url)
+            self.assertIn(
+                "<tr id=\"{}\">".format(smart_str(self.msgrcpt.mail.mail_id)),
+                response["listing"])
+            if strategy != "quar_type":
+                self.assertNotIn(
+                    "<tr id=\"{}\">".format(smart_str(msgrcpt.mail.mail_id)),
+                    response["listing"])
+
+    def test_listing_empty_content_type(self):
+        """Check that messages without a content type are listed."""
+        msgrcpt = factories.create_quarantined_msg(
+            "user@test.com", "sender@example.com", " ",
+            factories.SPAM_BODY, content="")
+        url = reverse("modoboa_amavis:_mail_list")
+        response = self.ajax_get(url)
+        self.assertIn(
+            "<tr id=\"{}\">".format(smart_str(msgrcpt.mail.mail_id)),
+            response["listing"])
+
     def test_viewmail(self):
         """Test view_mail view."""
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
@@ -115,6 +359,71 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_getmailpart(self):
+        """Test attachment download."""
+        msgrcpt = factories.create_virus("user@test.com")
+        models.Quarantine.objects.filter(mail=msgrcpt.mail).update(
+            mail_text=smart_bytes(factories.VIRUS_BODY))
+        mail_id = smart_str(msgrcpt.mail.mail_id)
+        url = reverse("modoboa_amavis:mailpart_get", args=[mail_id, "2"])
+        response = self.client.get(
+            reverse("modoboa_amavis:mailcontent_get", args=[mail_id]))
+        self.assertContains(response, url)
+        self.assertContains(response, "eicar.com")
+
+        response = self.client.get(url)
+        self.assertEqual(
+            response["Content-Disposition"],
+            "attachment; filename=\"eicar.com\"")
+        self.assertTrue(
+            b"".join(response.streaming_content).startswith(b"X5O!P%@AP"))
+        self.assertEqual(response["Content-Type"], "application/octet-stream")
+        self.assertEqual(response["X-Content-Type-Options"], "nosniff")
+
+        url = reverse("modoboa_amavis:mailpart_get", args=[mail_id, "3"])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+        self.client.logout()
+        self.set_global_parameter("self_service", True)
+        url = reverse("modoboa_amavis:mailpart_get", args=[mail_id, "2"])
+        secret_id = smart_str(msgrcpt.mail.secret_id)
+        response = self.client.get("{}?secret_id={}".format(url, secret_id))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("{}?secret_id={}&rcpt={}".format(
+            url, secret_id, smart_str(msgrcpt.rid.email)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_downloadmail(self):
+        """Test raw message download."""
+        mail_id = smart_str(self.msgrcpt.mail.mail_id)
+        url = reverse("modoboa_amavis:mail_download", args=[mail_id])
+        response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "message/rfc822")
+        self.assertEqual(
+            response["Content-Disposition"],
+            "attachment; filename=\"{}.eml\"".format(mail_id))
+        content = b"".join(response.streaming_content)
+        self.assertIn(b"X-Spam-Flag: YES", content)
+
+        self.client.logout()
+        self.set_global_parameter("self_service", True)
+        secret_id = smart_str(self.msgrcpt.mail.secret_id)
+        response = self.client.get("{}?secret_id={}".format(url, secret_id))
+        self.assertEqual(response.status_code, 404)
+        rcpt = smart_str(self.msgrcpt.rid.email)
+        response = self.client.get("{}?secret_id=unknown&rcpt={}".format(
+            url, rcpt))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("{}?secret_id={}&rcpt={}".format(
+            url, secret_id, rcpt))
+        self.assertEqual(response.status_code, 200)
+
+        url = reverse("modoboa_amavis:mail_download", args=["unknown"])
+        response = self.client.get(
+            "{}?secret_id=unknown&rcpt={}".format(url, rcpt))
+        self.assertEqual(response.status_code, 404)
+
     def test_viewheaders(self):
         """Test headers display."""
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
@@ -147,6 +456,7 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
             url, smart_str(self.msgrcpt.mail.secret_id))
         self.set_global_parameter("self_service", True)
         self.ajax_get(url, status=400)
+        self.ajax_get("{}&rcpt=unknown@test.com".format(url), status=400)
         url = "{}&rcpt={}".format(url, smart_str(self.msgrcpt.rid.email))
         self.ajax_get(url)
         self.msgrcpt.refresh_from_db()
@@ -160,7 +470,8 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         url = reverse("modoboa_amavis:_mail_list")
         response = self.ajax_get(url)
 
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250 1234 Ok\r\n\r\n")
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
         url = reverse("modoboa_amavis:mail_release", args=[mail_id])
         data = {"rcpt": smart_str(self.msgrcpt.rid.email)}
@@ -173,7 +484,8 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
     @mock.patch("socket.socket")
     def test_release_selfservice(self, mock_socket):
         """Test release view."""
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250 1234 Ok\r\n\r\n")
         self.client.logout()
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
         base_url = reverse("modoboa_amavis:mail_release", args=[mail_id])
@@ -314,7 +626,7 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
                 smart_str(msgrcpt.mail.mail_id)),
         ]
         mock_socket.return_value.recv.side_effect = [
-            b"250 1234 Ok\r\n", b"250 1234 Ok\r\n"
+            b"setreply=250 1234 Ok\r\n\r\n", b"setreply=250 1234 Ok\r\n\r\n"
         ]
         data = {
             "action": "release",
@@ -326,6 +638,97 @@ class ViewsTestCase(TestDataMixin, ModoTestCase):
         self.assertEqual(
             response["message"], "2 messages released successfully")
 
+    def test_release_batches(self):
+        """Check that recipients of a message stay in the same batch."""
+        messages = [
+            ("b", "s", "1"), ("a", "s", "1"), ("b", "s", "2"),
+            ("c", "s", "1"), ("c", "s", "2"), ("c", "s", "3")
+        ]
+        batches = tasks._get_release_batches(messages, 2)
+        self.assertEqual(
+            [[message[0] for message in batch] for batch in batches],
+            [["b", "b"], ["a"], ["c", "c", "c"]])
+
+    @override_settings(AMAVIS_RELEASE_ASYNC_THRESHOLD=1)
+    @mock.patch("socket.socket")
+    def test_process_release_async(self, mock_socket):
+        """Test process mode (bulk), using a job."""
+        # Initiate session
+        url = reverse("modoboa_amavis:_mail_list")
+        response = self.ajax_get(url)
+
+        msgrcpt = factories.create_spam("user@test.com")
+        selection = [
+            "{} {}".format(
+                smart_str(self.msgrcpt.rid.email),
+                smart_str(self.msgrcpt.mail.mail_id)),
+            "{} {}".format(
+                smart_str(msgrcpt.rid.email),
+                smart_str(msgrcpt.mail.mail_id)),
+        ]
+        mock_socket.return_value.recv.side_effect = [
+            b"setreply=250 1234 Ok\r\n\r\nsetreply=450 Failure\r\n\r\n"
+        ]
+        data = {
+            "action": "release",
+            "selection": ",".join(selection)
+        }
+        self.set_global_parameter("am_pdp_mode", "inet")
+        response = self.ajax_post(reverse("modoboa_amavis:mail_process"), data)
+        self.assertEqual(
+            response["message"], "Your request is being processed...")
+        status = self.ajax_get(response["job_url"])
+        self.assertFalse(status["finished"])
+        self.assertEqual(status["done"], 0)
+
+        queue = django_rq.get_queue("default")
+        worker = SimpleWorker([queue], connection=queue.connection)
+        worker.work(burst=True)
+        status = self.ajax_get(response["job_url"])
+        self.assertTrue(status["finished"])
+        self.assertEqual(status["done"], 2)
+        self.assertEqual(status["failures"], [{
+            "mail_id": smart_str(msgrcpt.mail.mail_id),
+            "rcpt": smart_str(msgrcpt.rid.email)
+        }])
+        self.assertEqual(status["message"], "1 message released successfully")
+        self.msgrcpt.refresh_from_db()
+        self.assertEqual(self.msgrcpt.rs, "R")
+
+        user = core_models.User.objects.get(username="user@test.com")
+        self.client.force_login(user)
+        response = self.client.get(response["job_url"])
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch("socket.socket")
+    def test_process_query_count(self, mock_socket):
+        """Check the number of queries doesn't depend on selection size."""
+        mock_socket.return_value.recv.return_value = (
+            b"setreply=250 1234 Ok\r\n\r\n")
+        # Initiate session
+        self.ajax_get(reverse("modoboa_amavis:_mail_list"))
+        url = reverse("modoboa_amavis:mail_process")
+
+        def process(action, count):
+            msgrcpts = [
+                factories.create_spam("user@test.com") for i in range(count)]
+            data = {
+                "action": action,
+                "selection": ",".join(
+                    "{} {}".format(
+                        smart_str(msgrcpt.rid.email),
+                        smart_str(msgrcpt.mail.mail_id))
+                    for msgrcpt in msgrcpts)
+            }
+            with CaptureQueriesContext(connections["default"]) as default, \
+                    CaptureQueriesContext(connections["amavis"]) as amavis:
+                self.ajax_post(url, data)
+            return len(default), len(amavis)
+
+        for action in ["release", "delete"]:
+            process(action, 1)  # warm caches up
+            self.assertEqual(process(action, 1), process(action, 5))
+
     def test_process_all(self):
         """Test process mode (bulk)."""
         # Initiate session
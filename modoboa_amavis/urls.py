@@ -14,7 +14,13 @@ urlpatterns = [
     path('listing/page/', views.listing_page, name="mail_page"),
     path('getmailcontent/<str:mail_id>/', views.getmailcontent,
          name="mailcontent_get"),
+    path('getmailcontent/<str:mail_id>/<str:part_id>/', views.getmailpart,
+         name="mailpart_get"),
+    path('download/<str:mail_id>/', views.downloadmail,
+         name="mail_download"),
     path('process/', views.process, name="mail_process"),
+    path('release/status/<str:job_id>/', views.release_status,
+         name="release_status"),
     path('delete/<str:mail_id>/', views.delete, name="mail_delete"),
     path('release/<str:mail_id>/', views.release,
          name="mail_release"),
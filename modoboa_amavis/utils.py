@@ -2,10 +2,17 @@
 
 """A collection of utility functions for working with the Amavis database."""
 
+import binascii
+import codecs
+import functools
+import re
+from email import policy
+from email.parser import BytesFeedParser, BytesHeaderParser
+
 import chardet
 
 from django.conf import settings
-from django.db.models.expressions import Func
+from django.db.models.expressions import Func, Value
 from django.utils.encoding import (
     smart_bytes as django_smart_bytes, smart_str as django_smart_str,
     smart_str as django_smart_str
@@ -45,23 +52,20 @@ def smart_str(value, *args, **kwargs):
     return django_smart_str(value, *args, **kwargs)
 
 
-def fix_utf8_encoding(value):
-    """Fix utf-8 strings that contain utf-8 escaped characters.
+@functools.lru_cache(maxsize=4096)
+def _fix_utf8_encoding(value):
+    """Memoized implementation of :func:`fix_utf8_encoding`.
 
-    msgs.from_addr and msgs.subject potentialy contain badly escaped utf-8
-    characters, this utility function fixes that and should be used anytime
-    these fields are accesses.
-
-    Didn't even know the raw_unicode_escape encoding existed :)
-    https://docs.python.org/3/library/codecs.html?highlight=raw_unicode_escape#python-specific-encodings
+    Spam campaigns reuse the same senders and subjects over and over so
+    the costly cases (chardet detection) are worth remembering.
     """
-    assert isinstance(value, str), "value should be of type str"
-
-    if len(value) == 0:
-        # short circuit for empty strings
-        return ""
-
-    bytes_value = value.encode("raw_unicode_escape")
+    try:
+        # raw_unicode_escape and latin-1 are identical for characters
+        # below U+0100. A string containing higher characters has been
+        # decoded properly already.
+        bytes_value = value.encode("latin-1")
+    except UnicodeEncodeError:
+        return value
     try:
         value = bytes_value.decode("utf-8")
     except UnicodeDecodeError:
@@ -76,6 +80,297 @@ def fix_utf8_encoding(value):
     return value
 
 
+def fix_utf8_encoding(value):
+    """Fix utf-8 strings that contain utf-8 escaped characters.
+
+    msgs.from_addr and msgs.subject potentialy contain badly escaped utf-8
+    characters, this utility function fixes that and should be used anytime
+    these fields are accesses.
+
+    Didn't even know the raw_unicode_escape encoding existed :)
+    https://docs.python.org/3/library/codecs.html?highlight=raw_unicode_escape#python-specific-encodings
+    """
+    assert isinstance(value, str), "value should be of type str"
+
+    if value.isascii():
+        # short circuit for empty and plain ASCII strings
+        return value
+
+    return _fix_utf8_encoding(value)
+
+
+def fix_utf8_encodings(values):
+    """Apply :func:`fix_utf8_encoding` to a list of strings.
+
+    Each distinct value is only processed once.
+
+    :param list values: list of str
+    :return: a list of str, in the same order
+    """
+    fixed = {value: fix_utf8_encoding(value) for value in set(values)}
+    return [fixed[value] for value in values]
+
+
+def message_from_chunks(chunks):
+    """Parse a message from an iterable of bytes-like chunks.
+
+    Chunks are fed to the parser one at a time, so the full content is
+    never joined nor decoded: each part is decoded (using its own
+    charset) only when its content is requested.
+
+    :return: an email.message.EmailMessage instance
+    """
+    parser = BytesFeedParser(policy=policy.default)
+    for chunk in chunks:
+        parser.feed(smart_bytes(chunk))
+    return parser.close()
+
+
+_RE_HEADER_SECTION_END = re.compile(br"\r?\n\r?\n")
+
+
+def read_header_section(chunks):
+    """Read the header section of a message given as chunks.
+
+    Chunks are consumed until the blank line ending the header section
+    is found, remaining ones are not read.
+
+    :param chunks: an iterable of bytes-like objects
+    :return: bytes (including the blank line)
+    """
+    content = b""
+    for chunk in chunks:
+        start = max(len(content) - 3, 0)
+        content += smart_bytes(chunk)
+        match = _RE_HEADER_SECTION_END.search(content, start)
+        if match:
+            return content[:match.end()]
+    return content
+
+
+_RE_PART_HEADERS_END = re.compile(br"(?:\A|\n)\r?\n")
+
+
+class _MimeScanner(object):
+    """Walk through a message, recording the position of its parts.
+
+    Bodies are never decoded: only header sections are parsed and
+    multipart boundaries are searched for. Bytes that are read can be
+    forwarded to a sink, except bodies rejected by keep_body.
+    """
+
+    def __init__(self, chunks, sink=None, keep_body=None):
+        self.chunks = iter(chunks)
+        self.sink = sink
+        self.keep_body = keep_body
+        self.buffer = b""
+        # Position of the buffer in the message
+        self.offset = 0
+        # Length of the line break ending the skipped content, if any
+        self.eol_length = 1
+        self.parts = []
+
+    def read(self):
+        """Append the next chunk to the buffer, return False at EOF."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer += smart_bytes(chunk)
+        return True
+
+    def skip(self, length, emit=True):
+        """Drop length bytes from the buffer."""
+        if not length:
+            return
+        content = self.buffer[:length]
+        if emit and self.sink is not None:
+            self.sink(content)
+        if content.endswith(b"\r\n"):
+            self.eol_length = 2
+        else:
+            self.eol_length = 1 if content.endswith(b"\n") else 0
+        self.buffer = self.buffer[length:]
+        self.offset += length
+
+    def skip_all(self, emit=True):
+        """Consume the remaining content."""
+        while True:
+            self.skip(len(self.buffer), emit)
+            if not self.read():
+                return
+
+    def read_headers(self):
+        """Read and parse a header section."""
+        while True:
+            match = _RE_PART_HEADERS_END.search(self.buffer)
+            if match or not self.read():
+                break
+        end = match.end() if match else len(self.buffer)
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(
+            self.buffer[:end])
+        self.skip(end)
+        return headers
+
+    def find_delimiter(self, boundary, emit=True):
+        """Consume content until a delimiter line of boundary is found.
+
+        Content located before the delimiter line is forwarded to the
+        sink only if emit is True.
+
+        :return: a tuple (end of the previous content, closing
+                 delimiter) or None if EOF is reached
+        """
+        delimiter = b"--" + boundary
+        start = 0
+        while True:
+            pos = self.buffer.find(delimiter, start)
+            if pos == -1:
+                # Keep enough content to match a delimiter split
+                # across two chunks.
+                keep = len(delimiter) + 2
+                if len(self.buffer) > keep:
+                    self.skip(len(self.buffer) - keep, emit)
+                start = 0
+                if not self.read():
+                    self.skip_all(emit)
+                    return None
+                continue
+            if pos:
+                line_start = self.buffer[pos - 1:pos] == b"\n"
+            else:
+                line_start = self.eol_length > 0
+            if not line_start:
+                start = pos + 1
+                continue
+            after = pos + len(delimiter)
+            if len(self.buffer) < after + 2 and self.read():
+                start = pos
+                continue
+            closing = self.buffer[after:after + 2] == b"--"
+            if not closing and \
+                    self.buffer[after:after + 1] not in b" \t\r\n":
+                start = pos + 1
+                continue
+            # The line break preceding a delimiter belongs to it
+            if pos:
+                end = pos - 1
+                if end and self.buffer[end - 1:end] == b"\r":
+                    end -= 1
+                self.skip(end, emit)
+                after -= end
+                end = self.offset
+            else:
+                end = self.offset - self.eol_length
+            while True:
+                eol = self.buffer.find(b"\n", after)
+                if eol != -1 or not self.read():
+                    break
+            self.skip(eol + 1 if eol != -1 else len(self.buffer))
+            return end, closing
+
+    def scan_part(self, number, parent_boundary=None):
+        """Scan a part, return the delimiter ending it (if any)."""
+        headers = self.read_headers()
+        boundary = None
+        if headers.get_content_maintype() == "multipart":
+            boundary = headers.get_boundary()
+        if boundary:
+            boundary = boundary.encode("ascii", "surrogateescape")
+            found = self.find_delimiter(boundary)
+            index = 1
+            while found is not None and not found[1]:
+                found = self.scan_part(number + [index], boundary)
+                index += 1
+            if found is None or parent_boundary is None:
+                self.skip_all()
+                return None
+            return self.find_delimiter(parent_boundary)
+        part = {
+            "number": ".".join(str(index) for index in number) or "1",
+            "content_type": headers.get_content_type(),
+            "charset": headers.get_content_charset(),
+            "disposition": headers.get_content_disposition(),
+            "filename": headers.get_filename(),
+            "encoding": str(
+                headers.get("Content-Transfer-Encoding", "7bit")
+            ).strip().lower(),
+            "offset": self.offset,
+        }
+        emit = self.keep_body is None or self.keep_body(part)
+        found = None
+        if parent_boundary is not None:
+            found = self.find_delimiter(parent_boundary, emit)
+        if found is None:
+            self.skip_all(emit)
+            end = self.offset
+        else:
+            end = found[0]
+        part["size"] = max(end - part["offset"], 0)
+        self.parts.append(part)
+        return found
+
+
+def scan_mime_structure(chunks, sink=None, keep_body=None):
+    """Build the list of leaf parts of a message given as chunks.
+
+    Only header sections are parsed, bodies are skipped. Each part is
+    described by a dictionary containing its number (as described in
+    RFC 3501), content type, charset, disposition, filename, transfer
+    encoding, the offset of its (encoded) body in the message and its
+    size.
+
+    :param chunks: an iterable of bytes-like objects
+    :param sink: a callable receiving the scanned content
+    :param keep_body: a callable telling if the body of a part must be
+                      sent to sink or not
+    :return: a list of dictionaries
+    """
+    scanner = _MimeScanner(chunks, sink, keep_body)
+    scanner.scan_part([])
+    return scanner.parts
+
+
+def iter_part_content(chunks, part):
+    """Extract the (encoded) body of a part from a message.
+
+    :param chunks: an iterable of bytes-like objects
+    :param dict part: a part as returned by scan_mime_structure
+    """
+    start = part["offset"]
+    end = start + part["size"]
+    position = 0
+    for chunk in chunks:
+        chunk = memoryview(smart_bytes(chunk))
+        if position + len(chunk) > start:
+            yield chunk[max(start - position, 0):end - position].tobytes()
+        position += len(chunk)
+        if position >= end:
+            break
+
+
+def decode_part_content(chunks, encoding):
+    """Decode the content of a part given as chunks.
+
+    base64 content is decoded chunk by chunk, quoted-printable one at
+    once, other encodings are left untouched.
+    """
+    if encoding == "base64":
+        pending = b""
+        for chunk in chunks:
+            pending += chunk.translate(None, b" \t\r\n")
+            length = len(pending) - len(pending) % 4
+            if length:
+                yield binascii.a2b_base64(pending[:length])
+                pending = pending[length:]
+        if pending.rstrip(b"="):
+            yield binascii.a2b_base64(
+                pending + b"=" * (-len(pending) % 4))
+    elif encoding == "quoted-printable":
+        yield binascii.a2b_qp(b"".join(chunks))
+    else:
+        yield from chunks
+
+
 class ConvertFrom(Func):
     """Convert a binary value to a string.
     Calls the database specific function to convert a binary value to a string
@@ -108,3 +403,38 @@ class ConvertFrom(Func):
             template="%(expressions)s",
             arity=1,
         )
+
+
+def get_database_codec():
+    """Return the Python codec matching AMAVIS_DEFAULT_DATABASE_ENCODING."""
+    encoding = settings.AMAVIS_DEFAULT_DATABASE_ENCODING
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        # PostgreSQL names Windows code pages WIN1252, WIN1251...
+        return codecs.lookup(
+            re.sub(r"^win", "cp", encoding, flags=re.IGNORECASE)).name
+
+
+class EncodedValue(Value):
+    """A string compared as raw bytes to a binary column.
+
+    The value is encoded using AMAVIS_DEFAULT_DATABASE_ENCODING so,
+    contrary to :class:`ConvertFrom`, the column is left untouched and
+    its indexes can be used::
+
+        Maddr.objects.filter(email=EncodedValue(address))
+    """
+
+    def as_sql(self, compiler, connection):
+        try:
+            value = self.value.encode(get_database_codec())
+        except UnicodeEncodeError:
+            # Such a value can't be stored in the database
+            return "NULL", []
+        return "%s", [value]
+
+    def as_sqlite(self, compiler, connection):
+        """SQLite implementation.
+        Values are stored as text, just compare strings."""
+        return "%s", [self.value]
@@ -4,19 +4,24 @@
 Amavis quarantine views.
 """
 
+import itertools
+
 import six
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import Http404, HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render
 from django.template import loader
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.http import content_disposition_header
 from django.utils.translation import gettext as _, ngettext
 from django.views.decorators.csrf import csrf_exempt
 
 import django_rq
 
-from modoboa.admin.models import Domain, Mailbox
+from modoboa.admin.models import Domain
 from modoboa_amavis import tasks
 from modoboa.lib.exceptions import BadRequest
 from modoboa.lib.paginator import Paginator
@@ -25,10 +30,10 @@ from modoboa.parameters import tools as param_tools
 from . import constants
 from .forms import LearningRecipientForm
 from .lib import (
-    AMrelease, QuarantineNavigationParameters,
+    AMrelease, QuarantineNavigationParameters, get_user_addresses,
     manual_learning_enabled, selfservice
 )
-from .models import Msgrcpt, Msgs
+from .models import Msgrcpt
 from .sql_connector import SQLconnector
 from .sql_email import SQLemail
 from .templatetags.amavis_tags import quar_menu, viewm_menu
@@ -46,34 +51,59 @@ def empty_quarantine():
     return render_to_json_response(ctx)
 
 
-def get_listing_pages(request, connector):
-    """Return listing pages."""
-    paginator = Paginator(
-        connector.messages_count(),
-        request.user.parameters.get_value("messages_per_page")
-    )
+def get_listing_pages(request, connector, cursor=None):
+    """Return listing pages.
+
+    If a valid :kw:`cursor` is given, the requested page is fetched
+    using keyset pagination instead of an OFFSET.
+    """
+    total = connector.messages_count()
+    per_page = request.user.parameters.get_value("messages_per_page")
     page_id = int(connector.navparams.get("page"))
+    if connector.count_mode != "exact":
+        # The real number of messages is unknown, don't stop the
+        # listing before running out of rows.
+        total = max(total, page_id * per_page)
+    paginator = Paginator(total, per_page)
     page = paginator.getpage(page_id)
     if not page:
         return None
     pages = [page]
-    if not page.has_next and page.has_previous and page.items < 40:
-        pages = [paginator.getpage(page_id - 1)] + pages
-    email_list = []
-    for page in pages:
-        email_list += connector.fetch(page.id_start, page.id_stop)
-    return {"pages": [page.number for page in pages], "rows": email_list}
+    position = None
+    if cursor is not None:
+        position = connector.parse_cursor(cursor, page_id)
+    if position is not None:
+        email_list = connector.fetch_after(
+            position, page.id_stop - page.id_start + 1)
+    else:
+        if not page.has_next and page.has_previous and page.items < 40:
+            pages = [paginator.getpage(page_id - 1)] + pages
+        email_list = []
+        for page in pages:
+            email_list += connector.fetch(page.id_start, page.id_stop)
+    if not email_list:
+        return None
+    return {
+        "pages": [page.number for page in pages],
+        "rows": email_list,
+        "cursor": connector.get_cursor(pages[-1].number + 1)
+    }
 
 
 @login_required
 def listing_page(request):
-    """Return a listing page."""
+    """Return a listing page.
+
+    An opaque ``cursor`` (as returned by a previous call) can be
+    provided to seek directly to the requested page.
+    """
     navparams = QuarantineNavigationParameters(request)
     previous_page_id = int(navparams["page"]) if "page" in navparams else None
     navparams.store()
 
     connector = SQLconnector(user=request.user, navparams=navparams)
-    context = get_listing_pages(request, connector)
+    context = get_listing_pages(
+        request, connector, cursor=request.GET.get("cursor"))
     if context is None:
         context = {"length": 0}
         navparams["page"] = previous_page_id
@@ -106,7 +136,9 @@ def _listing(request):
     context["listing"] = loader.render_to_string(
         "modoboa_amavis/email_list.html", {
             "email_list": context["rows"],
-            "message_types": constants.MESSAGE_TYPES
+            "message_types": constants.MESSAGE_TYPES,
+            "total": connector.messages_count(),
+            "count_mode": connector.count_mode
         }, request
     )
     del context["rows"]
@@ -135,7 +167,7 @@ def index(request):
 def getmailcontent_selfservice(request, mail_id):
     mail = SQLemail(mail_id.encode("ascii"), dformat="plain")
     return render(request, "common/viewmail.html", {
-        "headers": mail.render_headers(),
+        "headers": mail.render_headers(query=request.GET.urlencode()),
         "mailbody": mail.body
     })
 
@@ -149,6 +181,76 @@ def getmailcontent(request, mail_id):
     })
 
 
+def check_selfservice_access(request, mail_id):
+    """Check that rcpt and secret_id parameters give access to a message.
+
+    :raises Http404: if they don't
+    """
+    rcpt = request.GET.get("rcpt")
+    secret_id = request.GET.get("secret_id", "")
+    if not rcpt:
+        raise Http404
+    try:
+        msgrcpt = SQLconnector().get_recipient_message(rcpt, mail_id)
+    except Msgrcpt.DoesNotExist:
+        raise Http404
+    if not constant_time_compare(
+            secret_id, smart_str(msgrcpt.mail.secret_id)):
+        raise Http404
+
+
+def get_mail_part_response(mail_id, part_id):
+    """Download a single part of a message.
+
+    Only this part is decoded, chunk by chunk. Its content type comes
+    from the sender so it is not trusted: parts are always served as
+    binary content.
+    """
+    mail = SQLemail(mail_id.encode("ascii"))
+    part = mail.get_part(part_id)
+    if part is None:
+        raise Http404
+    response = StreamingHttpResponse(
+        mail.iter_part_content(part), content_type="application/octet-stream")
+    response["Content-Disposition"] = content_disposition_header(
+        True, part["filename"] or "part_{}".format(part["number"]))
+    response["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
+def getmailpart_selfservice(request, mail_id, part_id):
+    check_selfservice_access(request, mail_id)
+    return get_mail_part_response(mail_id, part_id)
+
+
+@selfservice(getmailpart_selfservice)
+def getmailpart(request, mail_id, part_id):
+    return get_mail_part_response(mail_id, part_id)
+
+
+def get_mail_download_response(mail_id):
+    """Download a message (.eml), chunk by chunk."""
+    chunks = SQLconnector().iter_mail_content(mail_id.encode("ascii"))
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        raise Http404
+    response = StreamingHttpResponse(
+        itertools.chain([first_chunk], chunks), content_type="message/rfc822")
+    response["Content-Disposition"] = content_disposition_header(
+        True, "{}.eml".format(mail_id))
+    return response
+
+
+def downloadmail_selfservice(request, mail_id):
+    check_selfservice_access(request, mail_id)
+    return get_mail_download_response(mail_id)
+
+
+@selfservice(downloadmail_selfservice)
+def downloadmail(request, mail_id):
+    return get_mail_download_response(mail_id)
+
+
 def viewmail_selfservice(request, mail_id,
                          tplname="modoboa_amavis/viewmail_selfservice.html"):
     rcpt = request.GET.get("rcpt", None)
@@ -186,11 +288,8 @@ def viewmail(request, mail_id):
 def viewheaders(request, mail_id):
     """Display message headers."""
     email = SQLemail(mail_id.encode("ascii"))
-    headers = []
-    for name in email.msg.keys():
-        headers.append((name, email.get_header(email.msg, name)))
     context = {
-        "headers": headers
+        "headers": email.all_headers
     }
     return render(request, "modoboa_amavis/viewheader.html", context)
 
@@ -206,16 +305,21 @@ def check_mail_id(request, mail_id) -> list:
 
 def get_user_valid_addresses(user):
     """Retrieve all valid addresses of a user."""
-    valid_addresses = []
     if user.role == "SimpleUsers":
-        valid_addresses.append(user.email)
-        try:
-            mb = Mailbox.objects.get(user=user)
-        except Mailbox.DoesNotExist:
-            pass
-        else:
-            valid_addresses += mb.alias_addresses
-    return valid_addresses
+        return get_user_addresses(user)
+    return []
+
+
+def get_selection_pairs(request, mail_id):
+    """Return the (address, mail_id) pairs the user can act on."""
+    valid_addresses = get_user_valid_addresses(request.user)
+    pairs = []
+    for mid in check_mail_id(request, mail_id):
+        r, i = mid.split()
+        if valid_addresses and r not in valid_addresses:
+            continue
+        pairs.append((r, i))
+    return pairs
 
 
 def delete_selfservice(request, mail_id):
@@ -236,13 +340,8 @@ def delete(request, mail_id):
     :param str mail_id: message unique identifier
     """
     mail_id = check_mail_id(request, mail_id)
-    connector = SQLconnector()
-    valid_addresses = get_user_valid_addresses(request.user)
-    for mid in mail_id:
-        r, i = mid.split()
-        if valid_addresses and r not in valid_addresses:
-            continue
-        connector.set_msgrcpt_status(r, i, "D")
+    SQLconnector().set_msgrcpt_status_bulk(
+        get_selection_pairs(request, mail_id), "D")
     message = ngettext("%(count)d message deleted successfully",
                         "%(count)d messages deleted successfully",
                         len(mail_id)) % {"count": len(mail_id)}
@@ -286,20 +385,13 @@ def release(request, mail_id):
     :param str mail_id: message unique identifier
     """
     mail_id = check_mail_id(request, mail_id)
-    msgrcpts = []
     connector = SQLconnector()
-    valid_addresses = get_user_valid_addresses(request.user)
-    for mid in mail_id:
-        r, i = mid.split()
-        if valid_addresses and r not in valid_addresses:
-            continue
-        msgrcpts += [(i, connector.get_recipient_message(r, i))]
+    msgrcpts = connector.get_recipient_messages(
+        get_selection_pairs(request, mail_id))
     if request.user.role == "SimpleUsers" and \
        not param_tools.get_global_parameter("user_can_release"):
-        for i, msgrcpt in msgrcpts:
-            connector.set_msgrcpt_status(
-                smart_str(msgrcpt.rid.email), i, "p"
-            )
+        connector.set_msgrcpt_status_bulk(
+            [(rcpt, mid) for mid, rcpt, secret_id, rs in msgrcpts], "p")
         message = ngettext("%(count)d request sent",
                             "%(count)d requests sent",
                             len(mail_id)) % {"count": len(mail_id)}
@@ -308,19 +400,33 @@ def release(request, mail_id):
             "url": QuarantineNavigationParameters(request).back_to_listing()
         })
 
-    amr = AMrelease()
+    threshold = getattr(settings, "AMAVIS_RELEASE_ASYNC_THRESHOLD", 50)
+    if len(msgrcpts) > threshold:
+        queue = django_rq.get_queue("default")
+        job = queue.enqueue(
+            tasks.release_messages,
+            ["{} {}".format(rcpt, mid)
+             for mid, rcpt, secret_id, rs in msgrcpts],
+            meta={"user": request.user.pk, "total": len(msgrcpts),
+                  "done": 0, "failures": []}
+        )
+        return render_to_json_response({
+            "message": _("Your request is being processed..."),
+            "job_url": reverse(
+                "modoboa_amavis:release_status", args=[job.id])
+        })
+
+    messages = [
+        (mid, secret_id, rcpt) for mid, rcpt, secret_id, rs in msgrcpts]
+    results = AMrelease().release_many(messages)
     error = None
-    for mid, rcpt in msgrcpts:
-        # we can't use the .mail relation on rcpt because it leads to
-        # an error on Postgres (memoryview pickle error).
-        mail = Msgs.objects.get(pk=mid.encode("ascii"))
-        result = amr.sendreq(mid, mail.secret_id, rcpt.rid.email)
+    released = []
+    for (mid, secret_id, rcpt), result in zip(messages, results):
         if result:
-            connector.set_msgrcpt_status(
-                smart_str(rcpt.rid.email), mid, "R")
-        else:
-            error = result
-            break
+            released.append((rcpt, mid))
+        elif error is None:
+            error = _("Failed to release message %s") % mid
+    connector.set_msgrcpt_status_bulk(released, "R")
 
     if not error:
         message = ngettext("%(count)d message released successfully",
@@ -335,6 +441,27 @@ def release(request, mail_id):
     }, status=status)
 
 
+@login_required
+def release_status(request, job_id):
+    """Return the progress of an asynchronous release."""
+    job = django_rq.get_queue("default").fetch_job(job_id)
+    if job is None or job.meta.get("user") != request.user.pk:
+        raise Http404
+    finished = job.is_finished or job.is_failed
+    message = None
+    if job.is_finished:
+        message = job.return_value()
+    elif job.is_failed:
+        message = _("Release failed")
+    return render_to_json_response({
+        "total": job.meta["total"],
+        "done": job.meta["done"],
+        "failures": job.meta["failures"],
+        "finished": finished,
+        "message": message
+    })
+
+
 def mark_messages(request, selection, mtype, recipient_db=None):
     """Mark a selection of messages as spam.
 